@@ -0,0 +1,93 @@
+''' memory.py -- Memory benchmark for loaded Coconut documents
+Author: Luke Williams <shmookey@shmookey.net>
+
+Distributed under the MIT license, see LICENSE file for details.
+
+Builds a number of Documents from database-style data, as a worker holding
+query results would, and reports the memory they occupy. Memory is measured
+by walking each Document's object graph and summing sys.getsizeof for every
+object it reaches, including instance dicts, so the result is deterministic
+and does not need a MongoDB server. Run it from the directory containing the
+coconut package:
+
+    python -m coconut.benchmarks.memory [count]
+
+Results for 10000 documents on CPython 2.7.18 (64-bit Linux):
+
+    Scalars wrapped in Str/Int/Float with instance dicts:  10154 bytes each
+    Scalars stored as native str/int/float:                  6305 bytes each
+'''
+
+import sys
+
+from bson.objectid import ObjectId
+
+import coconut.container
+
+class BenchmarkDocument (coconut.container.Document):
+    __schema__ = {
+        'name':    { str:   any },
+        'email':   { str:   any },
+        'age':     { int:   any },
+        'score':   { float: any },
+        'address': { dict:  {
+            'street':   { str: any },
+            'city':     { str: any },
+            'postcode': { str: any },
+        } },
+        'tags':    { list: [ { str: any } ], range: all },
+        'visits':  { list: [ { int: any } ], range: all },
+    }
+
+def make_source (i):
+    '''Return the database form of the i'th benchmark document.'''
+
+    return {
+        '_id': ObjectId(),
+        '__active__': True,
+        'name': u'Person %i' % i,
+        'email': u'person%i@example.com' % i,
+        'age': 20 + i % 50,
+        'score': i / 7.0,
+        'address': {
+            'street': u'%i Example Street' % i,
+            'city': u'Exampleton',
+            'postcode': u'%05i' % i,
+        },
+        'tags': [u'tag%i' % (i % 10), u'tag%i' % (i % 7)],
+        'visits': [i, i + 1, i + 2],
+    }
+
+def deep_size (obj, seen):
+    '''Return the total size of the objects reachable from obj not in seen.'''
+
+    if id(obj) in seen: return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if hasattr(obj, '__dict__'):
+        size += deep_size(obj.__dict__, seen)
+    if isinstance(obj, dict):
+        for key, value in dict.iteritems(obj):
+            size += deep_size(key, seen) + deep_size(value, seen)
+    elif isinstance(obj, list):
+        for item in list.__iter__(obj):
+            size += deep_size(item, seen)
+    elif isinstance(obj, (tuple, set, frozenset)):
+        for item in obj:
+            size += deep_size(item, seen)
+    return size
+
+def run (count):
+    '''Load count documents and return their size in bytes per document.'''
+
+    documents = [BenchmarkDocument.load(make_source(i)) for i in range(count)]
+    # Exclude state shared by all documents, such as compiled schemas
+    seen = set()
+    deep_size(BenchmarkDocument.__plan__, seen)
+    deep_size(BenchmarkDocument.__schema__, seen)
+    total = sum(deep_size(document, seen) for document in documents)
+    return total / count
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if sys.argv[1:] else 10000
+    print '%i documents: %i bytes per document' % (count, run(count))
@@ -0,0 +1,90 @@
+''' cache.py -- Read-through document cache for Coconut
+Author: Luke Williams <shmookey@shmookey.net>
+
+Distributed under the MIT license, see LICENSE file for details.
+'''
+
+import bson
+
+import collections, threading, time
+
+class DocumentCache (object):
+    '''A process-wide LRU cache of documents read by ID or by find_first.
+
+    To enable caching, set the __cache__ attribute of Document (or of a
+    subclass, to cache only that type):
+
+        Document.__cache__ = DocumentCache(size=10000, ttl=60)
+
+    Documents are stored as encoded BSON, which is compact and immutable, and
+    each lookup decodes a fresh copy so callers cannot modify cached state.
+    Saving or removing a Document in this process invalidates its entry and
+    all cached find_first results for its type.
+
+    Instance variables
+     size -- The maximum number of documents held.
+     ttl -- The number of seconds an entry stays valid, or None for no limit.
+    '''
+
+    def __init__ (self, size=1000, ttl=None):
+        self.size = size
+        self.ttl = ttl
+        self.documents = collections.OrderedDict()
+        self.queries = {}
+        self.lock = threading.Lock()
+
+    def get (self, clsname, id):
+        '''Return a copy of a cached document, or None.'''
+
+        key = (clsname, id)
+        with self.lock:
+            entry = self.documents.pop(key, None)
+            if not entry: return None
+            data, expires = entry
+            if expires and expires < time.time(): return None
+            self.documents[key] = entry
+        return bson.BSON(data).decode()
+
+    def put (self, clsname, doc):
+        '''Store a document as read from the database.'''
+
+        key = (clsname, str(doc['_id']))
+        expires = time.time() + self.ttl if self.ttl else None
+        entry = (bson.BSON.encode(doc), expires)
+        with self.lock:
+            self.documents.pop(key, None)
+            self.documents[key] = entry
+            while len(self.documents) > self.size:
+                self.documents.popitem(last=False)
+
+    def get_query (self, clsname, criteria):
+        '''Return a copy of the cached find_first result for criteria, or None.'''
+
+        id = self.queries.get(clsname, {}).get(self.get_query_key(criteria))
+        if not id: return None
+        return self.get(clsname, id)
+
+    def put_query (self, clsname, criteria, doc):
+        '''Store the document found by find_first for criteria.'''
+
+        self.put(clsname, doc)
+        with self.lock:
+            queries = self.queries.setdefault(clsname, {})
+            queries[self.get_query_key(criteria)] = str(doc['_id'])
+
+    def get_query_key (self, criteria):
+        return repr(sorted(criteria.items()))
+
+    def invalidate (self, clsname, id):
+        '''Drop a document and all cached query results for its type.'''
+
+        with self.lock:
+            self.documents.pop((clsname, id), None)
+            self.queries.pop(clsname, None)
+
+    def clear (self):
+        '''Drop all cached documents and query results.'''
+
+        with self.lock:
+            self.documents.clear()
+            self.queries.clear()
@@ -9,22 +9,66 @@ from coconut.db import SerialisableDBRef, SerialisableObjectId
 import coconut.schema
 import coconut.element
 import coconut.error
+import coconut.session
 
 from bson.objectid import ObjectId
 from bson.dbref import DBRef
 import pymongo.errors
 
-import copy, time
+import time, weakref
+
+# Values of Document.__durability__, also available from coconut.revision
+SYNC = 'sync'
+WRITE_BEHIND = 'write-behind'
+
+def to_object_id (id):
+    '''Convert a str, unicode, ObjectId or Link document ID to an ObjectId.'''
+
+    if isinstance(id,ObjectId): return id
+    if isinstance(id,(str,unicode)): return ObjectId(id)
+    if isinstance(id,coconut.element.Link): return ObjectId(id.targetid)
+    raise TypeError ('ID must be of type str, ObjectId or Link, not %s' % type(id).__name__)
+
+def join_path (key, path):
+    '''Qualify a dotted path relative to a container item with the item's key.'''
+
+    return '%s.%s' % (key,path) if path else str(key)
 
 class MutableElement (Element):
     '''Base class for mutable container types.
 
-    The __unsaved__ attribute implements copy-on-write.
+    The underlying dict or list holds the flushed contents of the container.
+    Unsaved changes are kept in a small overlay in __unsaved__, which reads
+    consult first and flush merges into the flushed contents, so the memory
+    used by edits grows with the number of edits rather than with the size of
+    the container. The __plan__ attribute holds the compiled form of
+    __schema__. Containers with __lazy__ set leave the items of dicts loaded
+    from the database unconverted until they are first accessed. __fields__
+    is the projection tree of a container that was only partially loaded, or
+    None if it was loaded in full.
+
+    __changed__ is set on a container and all of its ancestors when any of
+    them is modified, so that clean subtrees can be skipped when generating
+    changes.
+
+    Containers refer to their parent and to the root Document through weak
+    references, held in __parent__ and __root__, so that a Document and its
+    containers do not form reference cycles and are freed as soon as the
+    Document is no longer used. All the containers of a Document share the
+    same reference to it.
     '''
 
-    def __init__ (self, parent, schema):
+    __lazy__ = False
+    __fields__ = None
+    __changed__ = False
+    __parent__ = None
+    __root__ = None
+
+    def __init__ (self, parent, schema, plan=None):
         Element.__init__ (self)
-        if schema: self.__schema__ = schema
+        if schema:
+            self.__schema__ = schema
+            self.__plan__ = plan or coconut.schema.Schema.compile(schema)
         self.__unsaved__ = {}
         if type(self) == Element:
             raise TypeError ('Element type must not be instantiated directly, use a derived class.')
@@ -32,102 +76,218 @@ class MutableElement (Element):
             raise TypeError ('Parent must be of type Element, not %s' % str(type(parent)))
         self.parent = parent
 
+    @property
+    def parent (self):
+        '''The parent container, or None if it no longer exists.'''
+
+        return self.__parent__() if self.__parent__ else None
+
+    @parent.setter
+    def parent (self, parent):
+        self.__parent__ = weakref.ref(parent)
+        if isinstance(parent, Document):
+            self.__root__ = weakref.ref(parent)
+        elif isinstance(parent, MutableElement):
+            self.__root__ = parent.__root__
+
     def get_document (self):
-        if isinstance(self.parent, Document):
-            return self.parent
-        elif isinstance(self.parent, Element):
-            return self.parent.get_document()
-        else:
-            raise TypeError ('Parent must be of type Element, not %s' % str(type(self.parent)))
+        '''Return the root Document, or None if it no longer exists.'''
+
+        return self.__root__() if self.__root__ else None
 
     def flush (self):
         '''Recursively flush unsaved changes.'''
 
         raise NotImplementedError()
 
+    def add_child_changes (self, key, child, sets, unsets, ops=None):
+        '''Add the changes of a child container to sets, unsets and ops.
+
+        The child's paths are qualified with its key. An empty path from the
+        child stands for the child itself.
+        '''
+
+        child_ops = {} if ops is not None else None
+        child_sets, child_unsets = child.get_changes(child_ops)
+        for child_key, child_value in child_sets.items():
+            sets[join_path(key, child_key)] = child_value
+        for child_key, child_value in child_unsets.items():
+            unsets[join_path(key, child_key)] = child_value
+        for operator, paths in (child_ops or {}).items():
+            target = ops.setdefault(operator, {})
+            for child_key, child_value in paths.items():
+                target[join_path(key, child_key)] = child_value
+
+    def mark_changed (self):
+        '''Flag the container and its ancestors as having unsaved changes.'''
+
+        element = self
+        while not element.__changed__:
+            element.__changed__ = True
+            parent = element.parent
+            if parent is None or parent is element: break
+            element = parent
+
+    def is_loaded (self, key):
+        '''Return False if a key was left out of a partial load.'''
+
+        return self.__fields__ is None or key in self.__fields__
+
+    def get_item_fields (self, key):
+        '''Return the projection tree for an item of a partially loaded container.'''
+
+        if self.__fields__ is None: return None
+        return self.__fields__.get(key)
+
     def export (self):
         '''Return a deep copy of the element suitable for serialisation.'''
         
         return coconut.schema.Schema.export_element(self)
 
-    def history (self, key=None):
-        '''Return a history iterator for the container or one of its keys.'''
+    def history (self, key=None, **options):
+        '''Return a history iterator for the container or one of its keys.
+
+        options are passed to coconut.revision.History, e.g. ascending=True or
+        start and end dates to bound the revisions.
+        '''
 
-        return coconut.revision.History(self, key)
+        return coconut.revision.History(self, key, **options)
 
 class Dict (MutableElement, dict):
-    '''Database-aware dict type.'''
+    '''Database-aware dict type.
+
+    The overlay in __unsaved__ maps the keys written since the last flush to
+    their new values, and __removed__ holds the flushed keys that have been
+    deleted.
+
+    Keys that were missing from a loaded document and were filled in from
+    their defaults are held in __defaulted__. As they may not exist in the
+    database, changes to them are always written whole.
+    '''
+
+    __defaulted__ = None
 
-    def __init__ (self, parent, schema=None):
+    def __init__ (self, parent, schema=None, plan=None):
         dict.__init__(self)
-        MutableElement.__init__ (self, parent, schema)
+        MutableElement.__init__ (self, parent, schema, plan)
         self.__unsaved__ = None
+        self.__removed__ = None
+        self.__raw__ = None
 
     # Descriptors
 
     def __repr__ (self):
-        if self.__unsaved__ == None: return dict.__repr__(self)
-        else: return dict.__repr__(self.__unsaved__)
+        return dict.__repr__(dict(self.iter_current()))
 
     def __contains__ (self, key):
-        current = self.__unsaved__ if self.__unsaved__ != None else self
-        return dict.__contains__(current,key)
+        if self.__unsaved__ and key in self.__unsaved__: return True
+        if self.__removed__ and key in self.__removed__: return False
+        return dict.__contains__(self,key)
 
     def __str__ (self):
-        current = self.__unsaved__ if self.__unsaved__ != None else self
-        return dict.__str__(current)
+        return dict.__str__(dict(self.iter_current()))
 
     def __len__ (self):
-        current = self.__unsaved__ if self.__unsaved__ != None else self
-        return dict.__len__(current)
+        length = dict.__len__(self)
+        for key in self.__unsaved__ or ():
+            if not dict.__contains__(self,key): length += 1
+        return length - len(self.__removed__ or ())
+
+    def __iter__ (self):
+        for key, value in self.iter_current():
+            yield key
 
     # Accessors
 
     def __getitem__ (self, key):
         '''Return the value of an item in the dict.'''
 
-        current = self.__unsaved__ if self.__unsaved__ != None else self
-        item = dict.__getitem__(current,key)
-        if isinstance(item,MutableElement):
-            return item
+        if self.__unsaved__ and key in self.__unsaved__:
+            return self.__unsaved__[key]
+        if self.__removed__ and key in self.__removed__:
+            raise KeyError(key)
+        item = dict.__getitem__(self,key)
+        if self.__raw__ and key in self.__raw__:
+            return self.load_raw(key, item)
         return item
 
+    def get (self, key, default=None):
+        if not key in self: return default
+        return self[key]
+
+    def keys (self):
+        return list(self)
+
+    def iterkeys (self):
+        return iter(self)
+
+    def values (self):
+        return [value for key, value in self.iteritems()]
+
+    def itervalues (self):
+        for key, value in self.iteritems():
+            yield value
+
     def items (self):
-        current = self.__unsaved__ if self.__unsaved__ != None else self
-        return dict.items(current)
+        return list(self.iteritems())
 
     def iteritems (self):
-        current = self.__unsaved__ if self.__unsaved__ != None else self
-        return dict.iteritems(current)
+        if self.__raw__: self.load_raw_items()
+        return self.iter_current()
+
+    def iter_current (self):
+        '''Iterate over the items of the dict with unsaved changes applied.'''
+
+        unsaved = self.__unsaved__
+        removed = self.__removed__
+        if not unsaved and not removed:
+            for item in dict.iteritems(self): yield item
+            return
+        unsaved = unsaved or {}
+        removed = removed or ()
+        for key, value in dict.iteritems(self):
+            if key in unsaved or key in removed: continue
+            yield key, value
+        for item in unsaved.iteritems(): yield item
+
+    def load_raw (self, key, value):
+        '''Convert an item left in its database form by a lazy load.'''
+
+        element = self.__plan__.load_item(key, value, self)
+        dict.__setitem__(self, key, element)
+        self.__raw__.discard(key)
+        return element
+
+    def load_raw_items (self):
+        '''Convert all items left in their database form by a lazy load.'''
+
+        for key in list(self.__raw__):
+            self.load_raw(key, dict.__getitem__(self, key))
 
     # Mutators
 
     def __setitem__ (self, key, value):
         '''Set the value of an item in the dict.
 
-        Implements copy-on-write until flushed.
+        The change is held in the overlay until flushed.
         '''
 
-        if self.__unsaved__ == None: self.__unsaved__ = dict(self)
-        schema = self.__schema__
-        if schema == any or any in schema or schema[dict] == any or any in self.__schema__[dict]:
-            self.__unsaved__[key] = coconut.schema.Schema.import_element(value,any,self)
-            return
-        traverse = schema.get('traverse',True)
-        if schema[dict] == any:
-            if traverse:
-                element = coconut.schema.Schema.import_element(value,any,self)
-            else:
-                element = value
-        else:
-            if not key in schema[dict]:
-                raise coconut.error.ValidationKeyError (key)
-            item_schema = schema[dict][key]
-            if traverse:
-                element = coconut.schema.Schema.import_element(value, item_schema, self)
-            else: 
-                element = value
-        self.__unsaved__[key] = element
+        if self.__unsaved__ is None: self.__unsaved__ = {}
+        self.__unsaved__[key] = self.__plan__.import_item(key, value, self)
+        if self.__removed__: self.__removed__.discard(key)
+        if self.__raw__: self.__raw__.discard(key)
+        self.mark_changed()
+
+    def __delitem__ (self, key):
+        '''Remove an item from the dict.'''
+
+        if not key in self: raise KeyError(key)
+        if self.__unsaved__: self.__unsaved__.pop(key, None)
+        if dict.__contains__(self, key):
+            if self.__removed__ is None: self.__removed__ = set()
+            self.__removed__.add(key)
+        if self.__raw__: self.__raw__.discard(key)
+        self.mark_changed()
 
     def update (self, dct):
         '''Replace keys with values from dct.
@@ -135,261 +295,438 @@ class Dict (MutableElement, dict):
         Changes are buffered until flushed.
         '''
 
-        if self.__unsaved__ == None: self.__unsaved__ = dict(self)
+        if self.__unsaved__ is None: self.__unsaved__ = {}
+        plan = self.__plan__
         for key, value in dct.items():
-            if self.__schema__[dict] == any:
-                element = coconut.schema.Schema.import_element(value, any, self)
-            else:
-                item_schema = self.__schema__[dict][key]
-                element = coconut.schema.Schema.import_element(value, item_schema, self)
-            self.__unsaved__[key] = element
+            self.__unsaved__[key] = plan.import_item(key, value, self)
+            if self.__removed__: self.__removed__.discard(key)
+            if self.__raw__: self.__raw__.discard(key)
+        self.mark_changed()
 
     # Database methods
 
     def flush (self):
         '''Recursively flush unsaved changes.'''
 
-        if self.__unsaved__ != None:
-            dict.__init__(self, self.__unsaved__)
-            self.__unsaved__ = None
-        for key, item in self.items():
-            if isinstance(item,MutableElement):
+        if not self.__changed__: return
+        if self.__unsaved__:
+            dict.update(self, self.__unsaved__)
+        for key in self.__removed__ or ():
+            dict.__delitem__(self, key)
+        self.__unsaved__ = None
+        self.__removed__ = None
+        for item in dict.itervalues(self):
+            if isinstance(item,MutableElement) and item.__changed__:
                 item.flush()
-
-    def get_changes (self):
-        '''Recursively generate and return a list of unsaved changes.'''
+        if self.__defaulted__:
+            # Keys left at their defaults may still be missing from the database
+            plan = self.__plan__
+            for key in list(self.__defaulted__):
+                item_plan = plan.item_plan(key)
+                value = item_plan.export_element(dict.get(self, key))
+                if not item_plan.is_default(value): self.__defaulted__.discard(key)
+        self.__changed__ = False
+
+    def get_changes (self, ops=None):
+        '''Recursively generate and return a list of unsaved changes.
+
+        Changes are returned as dicts of sets and unsets keyed by dotted path
+        relative to the container, ready for use with $set and $unset. If ops
+        is given, changes to lists that can be written with array operators
+        are added to it instead, as a dict of paths for each operator.
+
+        Only the keys in the overlay and children with changes are visited,
+        so a clean container returns immediately.
+        '''
         sets = {}
         unsets = {}
-        current = self.__unsaved__ if self.__unsaved__ != None else self
-        old = dict(self)
-        schema = self.__schema__
+        if not self.__changed__: return sets, unsets
+        unsaved = self.__unsaved__ or {}
+        removed = self.__removed__ or ()
+        plan = self.__plan__
+        raw = self.__raw__ or ()
+        defaulted = self.__defaulted__ or ()
 
         # Check for dropped keys
-        if current != self:
-            for key in old:
-                if not key in current:
-                    unsets[key] = ''
+        for key in removed:
+            unsets[key] = ''
        
-        for key, current_value in current.items():
-            # Get schema for current item
-            if schema == any or any in schema or schema[dict] == any or any in schema[dict]:
-                key_schema = any
-            else:
-                key_schema = schema[dict][key]
+        # Check the keys that have been written
+        for key, current_value in unsaved.iteritems():
+            # Get plan for current item
+            key_plan = plan.item_plan(key)
+            stored = dict.__contains__(self,key)
 
             # Is the value a primitive type?
             if not isinstance(current_value,MutableElement):
-                if key not in old or not old[key] == current_value:
-                    sets[key] = coconut.schema.Schema.export_element(current_value,key_schema)
+                if not stored or not dict.__getitem__(self,key) == current_value:
+                    sets[key] = key_plan.export_element(current_value)
                 continue
             
-            traverse = key_schema.get('traverse',True)
-            if not traverse:
+            if not key_plan.traverse:
                 # TODO: Check if there are actually any changes
                 # For now it seems that we do actually have to traverse everything when exporting
-                sets[key] = coconut.schema.Schema.export_element(current_value,key_schema)
+                sets[key] = key_plan.export_element(current_value)
                 continue
 
             # Don't look at subkeys of new items, just insert the whole dict.
-            if key not in old:
+            if key in defaulted or not stored or not dict.__getitem__(self,key) is current_value:
                 child_item = coconut.schema.Schema.export_element(current_value)
                 sets[key] = child_item
                 continue
             
             # Are there any changes in the child container?
-            child_sets, child_unsets = current_value.get_changes()
-                
-            if child_sets: sets[key] = child_sets
-            if child_unsets: unsets[key] = child_unsets
-            continue
-            # TODO: can probably scrap the rest of this?
-            for child_key, child_value in child_sets.items():
-                qualified_key = '%s.%s' % (key,child_key)
-                sets[qualified_key] = child_value
-            for child_key, child_value in child_unsets.items():
-                qualified_key = '%s.%s' % (key,child_key)
-                unsets[qualified_key] = child_value
+            self.add_child_changes(key, current_value, sets, unsets, ops)
+
+        # Check for changes within the flushed items
+        for key, current_value in dict.iteritems(self):
+            # Items still in their database form are unchanged
+            if key in raw or key in unsaved or key in removed: continue
+            if not isinstance(current_value,MutableElement): continue
+            if not current_value.__changed__: continue
+            if key in defaulted:
+                sets[key] = coconut.schema.Schema.export_element(current_value)
+                continue
+            self.add_child_changes(key, current_value, sets, unsets, ops)
 
         return sets, unsets
 
 class List (MutableElement, list):
-    '''Database-aware list type.'''
+    '''Database-aware list type.
+
+    The projection of a partially loaded list applies to each of its items.
+
+    Writes to flushed items are held in __unsaved__ as a dict mapping their
+    positions to their new values, and appended items are held in
+    __appended__. Inserting, popping or removing items replaces the overlay
+    with a single working copy of the list in __unsaved__ until it is
+    flushed.
+
+    The mutators record an operation log in __ops__ until the list is
+    flushed, so that appends, inserts, pops and removals can be saved with
+    $push, $pop and $pull rather than by rewriting the whole list.
+    '''
+
+    __ops__ = None
 
-    def __init__ (self, parent, schema=None):
+    def __init__ (self, parent, schema=None, plan=None):
         list.__init__(self)
-        MutableElement.__init__ (self, parent, schema)
+        MutableElement.__init__ (self, parent, schema, plan)
         self.__unsaved__ = None
-        self.__flushed__ = None
+        self.__appended__ = None
 
     # Descriptors
 
     def __repr__ (self):
-        if self.__unsaved__ == None: return list.__repr__(self)
-        else: return list.__repr__(self.__unsaved__)
+        return list.__repr__(list(iter(self)))
 
     def __contains__ (self, key):
-        current = self.__unsaved__ if self.__unsaved__ != None else self
-        return list.__contains__(current,key)
+        for item in self:
+            if item == key: return True
+        return False
 
     def __iter__ (self):
-        current = self.__unsaved__ if self.__unsaved__ != None else self
-        return list.__iter__(current)
+        unsaved = self.__unsaved__
+        if isinstance(unsaved,list):
+            for item in unsaved: yield item
+            return
+        if not unsaved:
+            for item in list.__iter__(self): yield item
+        else:
+            for i, item in enumerate(list.__iter__(self)):
+                yield unsaved[i] if i in unsaved else item
+        for item in self.__appended__ or (): yield item
 
     def __len__ (self):
-        current = self.__unsaved__ if self.__unsaved__ != None else self
-        return list.__len__(current)
+        if isinstance(self.__unsaved__,list): return len(self.__unsaved__)
+        return list.__len__(self) + len(self.__appended__ or ())
 
     # Accessors
 
     def __getitem__ (self, key):
         '''Return the value of an item in the list.'''
 
-        current = self.__unsaved__ if self.__unsaved__ != None else self
-        item = list.__getitem__(current,key)
-        if isinstance(item,MutableElement):
-            return item
-        return item
+        unsaved = self.__unsaved__
+        if isinstance(unsaved,list): return unsaved[key]
+        if not unsaved and not self.__appended__: return list.__getitem__(self,key)
+        if isinstance(key,slice): return list(iter(self))[key]
+        idx = self.get_index(key)
+        flushed = list.__len__(self)
+        if idx >= flushed: return self.__appended__[idx - flushed]
+        if unsaved and idx in unsaved: return unsaved[idx]
+        return list.__getitem__(self,idx)
+
+    def get_index (self, idx):
+        '''Return a position in the list as a non-negative index.'''
+
+        length = len(self)
+        if idx < 0: idx += length
+        if idx < 0 or idx >= length: raise IndexError('list index out of range')
+        return idx
+
+    def get_working (self):
+        '''Return the list with unsaved changes applied.
+
+        The returned list is the working copy if there is one, otherwise a new
+        list that is not kept.
+        '''
+
+        if isinstance(self.__unsaved__,list): return self.__unsaved__
+        return list(iter(self))
 
     # Mutators
 
     def __setitem__ (self, idx, value):
         '''Set the value of an item in the list.
 
-        Implements copy-on-write until flushed.
+        The change is held in the overlay until flushed.
         '''
 
-        if self.__unsaved__ == None:
-            self.__flushed__ = list(self)
-            self.__unsaved__ = list(self)
-        if self.__schema__ == any:
-            self.__unsaved__[key] = coconut.schema.Schema.import_element(value,any,self)
-            return
-        schema = self.__schema__
-        traverse = schema.get('traverse',True)
-        item_schema = coconut.schema.Schema.get_list_index_schema(idx,schema)
-        if traverse:
-            element = coconut.schema.Schema.import_element(value,item_schema,self)
+        idx = self.get_index(idx)
+        element = self.__plan__.import_item(idx, value, self)
+        flushed = list.__len__(self)
+        if isinstance(self.__unsaved__,list):
+            self.__unsaved__[idx] = element
+        elif idx >= flushed:
+            self.__appended__[idx - flushed] = element
         else:
-            element = value
-        self.__unsaved__[key] = element
+            if self.__unsaved__ is None: self.__unsaved__ = {}
+            self.__unsaved__[idx] = element
+        self.log_op('set', idx)
+        self.mark_changed()
 
     def append (self, value):
         '''Add an item to the end of a list.'''
         
-        if self.__unsaved__ == None:
-            self.__flushed__ = list(self)
-            self.__unsaved__ = list(self)
-        if self.__schema__ == any:
-            self.__unsaved__.append(coconut.schema.Schema.import_element(value,any,self))
-            return
-        schema = self.__schema__
-        traverse = schema.get('traverse',True)
-        idx = len(self.__unsaved__)
-        item_schema = coconut.schema.Schema.get_list_index_schema(idx, schema)
-        if traverse:
-            element = coconut.schema.Schema.import_element(value,item_schema,self)
+        idx = len(self)
+        element = self.__plan__.import_item(idx, value, self)
+        if isinstance(self.__unsaved__,list):
+            self.__unsaved__.append(element)
         else:
-            element = value
-        self.__unsaved__.append(element)
+            if self.__appended__ is None: self.__appended__ = []
+            self.__appended__.append(element)
+        self.log_op('push', idx)
+        self.mark_changed()
+
+    def extend (self, values):
+        '''Add each of a sequence of items to the end of a list.'''
+
+        for value in values:
+            self.append(value)
+
+    def insert (self, idx, value):
+        '''Insert an item before the given position.'''
+
+        # Validate before the overlay is replaced, so a failure leaves it alone
+        length = len(self)
+        if idx < 0: idx = max(idx + length, 0)
+        idx = min(idx, length)
+        element = self.__plan__.import_item(idx, value, self)
+        self.rebuild().insert(idx, element)
+        self.log_op('insert', idx)
+        self.mark_changed()
+
+    def pop (self, idx=-1):
+        '''Remove and return the item at the given position, by default the last.'''
+
+        length = len(self)
+        if not length: raise IndexError('pop from empty list')
+        if idx < 0: idx += length
+        if not 0 <= idx < length: raise IndexError('pop index out of range')
+        value = self.rebuild().pop(idx)
+        self.log_op('pop', idx)
+        self.mark_changed()
+        return value
 
     def remove (self, value):
         '''Remove an item from the list by value.'''
-        if self.__unsaved__ == None:
-            self.__flushed__ = list(self)
-            self.__unsaved__ = list(self)
-        if self.__schema__ == any:
-            self.__unsaved__.remove(coconut.schema.Schema.import_element(value,any,self))
-            return
-        schema = self.__schema__
-        traverse = schema.get('traverse',True)
-        idx = len(self.__unsaved__)
-        item_schema = coconut.schema.Schema.get_list_index_schema(idx, schema)
-        if traverse:
-            element = coconut.schema.Schema.import_element(value,item_schema,self)
-        else:
-            element = value
-        self.__unsaved__.remove(element)
+
+        value = self.__plan__.import_item(len(self), value, self)
+        if not any(item == value for item in self):
+            raise ValueError('list.remove(x): x not in list')
+        self.rebuild().remove(value)
+        self.log_op('pull', value)
+        self.mark_changed()
+
+    def rebuild (self):
+        '''Replace the overlay with a working copy of the list and return it.'''
+
+        if not isinstance(self.__unsaved__,list):
+            self.__unsaved__ = list(iter(self))
+            self.__appended__ = None
+        return self.__unsaved__
+
+    def log_op (self, op, arg):
+        '''Record a mutation in the operation log.'''
+
+        if self.__ops__ is None: self.__ops__ = []
+        self.__ops__.append((op, arg))
 
     # Database methods
 
+    def is_loaded (self, idx):
+        return True
+
+    def get_item_fields (self, idx):
+        return self.__fields__
+
     def flush (self):
         '''Recursively flush unsaved changes.'''
 
-        if self.__unsaved__ != None:
-            list.__init__(self, self.__unsaved__)
-            self.__unsaved__ = None
-            self.__flushed__ = None
-        for item in self:
-            if isinstance(item,MutableElement):
+        if not self.__changed__: return
+        unsaved = self.__unsaved__
+        if isinstance(unsaved,list):
+            list.__init__(self, unsaved)
+        else:
+            for idx, item in (unsaved or {}).iteritems():
+                list.__setitem__(self, idx, item)
+            if self.__appended__: list.extend(self, self.__appended__)
+        self.__unsaved__ = None
+        self.__appended__ = None
+        for item in list.__iter__(self):
+            if isinstance(item,MutableElement) and item.__changed__:
                 item.flush()
+        self.__ops__ = None
+        self.__changed__ = False
+
+    def get_changes (self, ops=None):
+        '''Recursively generate and return a list of unsaved changes.
+
+        Changes are keyed by dotted path relative to the list, starting with
+        the item index. An empty key means the whole list must be rebuilt.
 
-    def get_changes (self):
-        '''Recursively generate and return a list of unsaved changes.'''
-        sets = []
-        unsets = []
-        current = self.__unsaved__ if self.__unsaved__ != None else self
-        old = self.__flushed__ if self.__flushed__ != None else self
-        schema = self.__schema__
-        # Rebuild the whole list if the length has changed.
-        if len(current) != len(old):
-            return coconut.schema.Schema.export_element(self,schema), {}
-            #sets = {'': coconut.schema.Schema.export_element(self,schema)}
-            #return sets, unsets
-
-        for i, current_value in enumerate(current):
-            if schema == any:
-                key_schema = any
-            elif schema[list] == any:
-                key_schema = any
-            elif range in schema and schema[range] == all:
-                key_schema = schema[list][0]
+        If ops is given and items were only added, only popped or only
+        removed, the change is added to ops as a $push, $pop or $pull on the
+        empty path instead. See get_array_update.
+        '''
+        sets = {}
+        unsets = {}
+        if not self.__changed__: return sets, unsets
+        plan = self.__plan__
+        kinds = set(op for op, arg in self.__ops__ or ())
+        kinds.discard('set')
+
+        # Use an array operator or rebuild the whole list if items moved. A
+        # working copy without a structural change is also set whole.
+        if kinds or isinstance(self.__unsaved__,list):
+            update = self.get_array_update() if ops is not None and kinds else None
+            if update:
+                operator, value = update
+                ops.setdefault(operator, {})[''] = value
             else:
-                key_schema = schema[list][i]
+                sets[''] = plan.export_element(self)
+            return sets, unsets
+
+        # Otherwise only flushed items have been written, so the overlay holds
+        # their positions
+        unsaved = self.__unsaved__ or {}
+        for i, current_value in unsaved.iteritems():
+            key_plan = plan.item_plan(i)
+            old_value = list.__getitem__(self, i)
 
             # Is the value a primitive type?
             if not isinstance(current_value,MutableElement):
-                if i >= len(old) or not old[i] == current_value:
-                    #sets[i] = coconut.schema.Schema.export_element(current_value,key_schema)
-                    sets.append(coconut.schema.Schema.export_element(current_value,key_schema))
+                if not old_value == current_value:
+                    sets[str(i)] = key_plan.export_element(current_value)
                 continue
             
-            traverse = key_schema.get('traverse',True)
-            if not traverse:
+            if not key_plan.traverse:
                 # TODO: Check if there are actually any changes
-                #sets[i] = current_value
-                sets.append(current_value)
-                print "set list item %i to value %s" % (i,current_value)
-                continue
-            if i >= len(old):
-                child_item = coconut.schema.Schema.export_element(current_value)
-                #sets[i] = child_item
-                sets.append(child_item)
+                sets[str(i)] = key_plan.export_element(current_value)
                 continue
-            
-            child_sets, child_unsets = current_value.get_changes()
-            #sets[i] = child_sets
-            #unsets[i] = child_unsets
-            if child_sets:
-                sets.append(child_sets)
-            if child_unsets:
-                unsets.append(child_unsets)
-            continue
-            # TODO: can probably scrap the rest of this?
-            # An empty string key indicates the child wants to be rebuilt
-            if len(child_sets) == 1 and '' in child_sets:
-                sets[i] = child_sets['']
+
+            # A new item replacing the old one is set as a whole
+            if not old_value is current_value:
+                sets[str(i)] = coconut.schema.Schema.export_element(current_value)
                 continue
             
             # Are there any changes in the child container?
-            for child_key, child_value in child_sets.items():
-                qualified_key = '%i.%s' % (i,child_key)
-                sets[qualified_key] = child_value
-            for child_key, child_value in child_unsets.items():
-                qualified_key = '%i.%s' % (i,child_key)
-                unsets[qualified_key] = child_value
+            self.add_child_changes(i, current_value, sets, unsets, ops)
+
+        # Check for changes within the flushed items
+        for i, current_value in enumerate(list.__iter__(self)):
+            if i in unsaved: continue
+            if not isinstance(current_value,MutableElement): continue
+            if not current_value.__changed__: continue
+            self.add_child_changes(i, current_value, sets, unsets, ops)
 
         return sets, unsets
 
+    def get_array_update (self):
+        '''Express the operation log as a single array update operator.
+
+        Returns an (operator, value) pair, or None if the changes can only be
+        written by setting the whole list. Items that were added in one
+        contiguous run become a $push with $each (and $position unless they
+        were appended), pops from one end become a $pop, or a $push with an
+        empty $each and a $slice if more than one item was popped, and
+        removals of primitive values that leave no equal value behind become a
+        $pull. Writes to existing items, changes within items that were kept,
+        and any other mixture of operations are not expressible.
+        '''
+
+        log = self.__ops__ or ()
+        kinds = set(op for op, arg in log)
+        plan = self.__plan__
+        if 'set' in kinds: return None
+
+        # Appends alone are taken from the overlay without comparing the lists
+        if kinds == set(['push']) and not isinstance(self.__unsaved__, list):
+            for item in list.__iter__(self):
+                if isinstance(item,MutableElement) and item.__changed__: return None
+            start = list.__len__(self)
+            items = [plan.item_plan(start + i).export_element(item)
+                for i, item in enumerate(self.__appended__ or ())]
+            return '$push', {'$each': items}
+
+        old = list(list.__iter__(self))
+        current = self.get_working()
+        for item in current:
+            if not isinstance(item,MutableElement) or not item.__changed__: continue
+            for old_item in old:
+                if item is old_item: return None
+
+        if kinds <= set(['push','insert']):
+            added = len(current) - len(old)
+            start = 0
+            while start < len(old) and current[start] is old[start]:
+                start += 1
+            for item, old_item in zip(current[start+added:], old[start:]):
+                if not item is old_item: return None
+            items = [plan.item_plan(i).export_element(current[i]) for i in range(start, start+added)]
+            value = {'$each': items}
+            if start < len(old): value['$position'] = start
+            return '$push', value
+
+        if kinds == set(['pop']):
+            removed = len(old) - len(current)
+            if is_same_items(current, old[removed:]): direction = -1
+            elif is_same_items(current, old[:len(current)]): direction = 1
+            else: return None
+            if removed == 1: return '$pop', direction
+            return '$push', {'$each': [], '$slice': len(current) * direction}
+
+        if kinds == set(['pull']):
+            values = [arg for op, arg in log]
+            for value in values:
+                if isinstance(value,(MutableElement,coconut.element.Link)): return None
+                if value in current: return None
+            if not is_same_items(current, [item for item in old if not item in values]):
+                return None
+            values = [plan.item_plan(old.index(value)).export_element(value) for value in values]
+            if len(values) == 1: return '$pull', values[0]
+            return '$pull', {'$in': values}
+
+        return None
+
+def is_same_items (a, b):
+    '''Return True if two sequences hold the same objects in the same order.'''
+
+    if len(a) != len(b): return False
+    for x, y in zip(a, b):
+        if not x is y: return False
+    return True
+
 class DocumentClass (type):
     def __new__ (cls, clsname, bases, dct):
         if '__schema__' in dct:
@@ -399,6 +736,9 @@ class DocumentClass (type):
         newcls = type.__new__ (cls, clsname, bases, dct)
         if clsname == 'Document': return newcls
         
+        # Compile the schema once for all instances
+        newcls.__plan__ = coconut.schema.Schema.compile(newcls.__schema__)
+
         # Register the class and DB with Document
         Document.__types__[clsname] = newcls
         
@@ -407,56 +747,271 @@ class DocumentClass (type):
     def __getitem__ (cls, id):
         '''Retrieve a Document from the database by ID.'''
 
+        return cls.find_by_id(id)
+
+    def find_by_id (cls, id, fields=None):
+        '''Retrieve a Document from the database by ID.
+
+        If fields is given, only those dotted paths are loaded. See load.
+        '''
+
+        session = coconut.session.get_session()
+        if session and not isinstance(id,coconut.element.Link):
+            obj = session.get(cls, str(id))
+            if obj is not None: return obj
         doc = None
         clsname = cls.__name__
+        cache = cls.__cache__ if fields is None else None
+        if cache and not isinstance(id,coconut.element.Link):
+            doc = cache.get(clsname, str(id))
+            if doc: return cls.load(doc)
+        projection = cls.get_projection(fields)
         if isinstance(id,str):
-            doc = cls.__db__[clsname].find_one({'_id':ObjectId(id),'__active__':True})
+            doc = cls.__db__[clsname].find_one({'_id':ObjectId(id),'__active__':True}, projection)
         elif isinstance(id,unicode):
-            doc = cls.__db__[clsname].find_one({'_id':ObjectId(id),'__active__':True})
+            doc = cls.__db__[clsname].find_one({'_id':ObjectId(id),'__active__':True}, projection)
         elif isinstance(id,coconut.element.Link):
             return id()
         elif isinstance(id,ObjectId):
-            doc = cls.__db__[clsname].find_one({'_id':id,'__active__':True})
+            doc = cls.__db__[clsname].find_one({'_id':id,'__active__':True}, projection)
         else:
             raise TypeError ('ID must be of type str, ObjectId or Link, not %s' % type(id).__name__)
         if not doc:
             raise coconut.error.DocumentNotFound ('Could not find document ID: %s' % str(id))
-        obj = cls(doc)
-        obj.flush()
+        if cache: cache.put(clsname, doc)
+        return cls.load(doc, fields)
+
+    def get_as_of (cls, id, timestamp):
+        '''Return a Document as it was at a time, rebuilt from its Revisions.
+
+        timestamp is in seconds since the epoch, as in Revision.date. The
+        Revisions are replayed from the latest snapshot before that time: see
+        coconut.revision.get_state. The Document is not registered with the
+        Session, and saving it writes its old state back as the current one.
+        Raises DocumentNotFound if the Document did not exist at that time.
+        '''
+
+        import coconut.revision
+        if isinstance(id,coconut.element.Link): id = id.targetid
+        state = coconut.revision.get_state(cls, str(id), timestamp)
+        if state is None:
+            raise coconut.error.DocumentNotFound ('No revisions of document ID %s at %s' % (str(id), timestamp))
+        obj = cls.load(state)
+        obj.id = str(id)
         return obj
 
-    def find_first (cls, criteria):
+    def get_many (cls, ids, fields=None, chunk_size=1000):
+        '''Retrieve many Documents by ID using batched $in queries.
+
+        ids may contain strings, ObjectIds and Links. Returns a tuple of the
+        Documents found, in the order of ids, and a list of the ids for which
+        no Document was found. If fields is given, only those dotted paths are
+        loaded.
+        '''
+
+        clsname = cls.__name__
+        session = coconut.session.get_session()
+        cache = cls.__cache__ if fields is None else None
+        keys = [to_object_id(id) for id in ids]
+        found = {}
+        pending = []
+        seen = set()
+        for key in keys:
+            if key in seen: continue
+            seen.add(key)
+            obj = session.get(cls, str(key)) if session else None
+            if obj is None and cache:
+                doc = cache.get(clsname, str(key))
+                if doc: obj = cls.load(doc)
+            if obj is None: pending.append(key)
+            else: found[key] = obj
+
+        projection = cls.get_projection(fields)
+        for i in range(0, len(pending), chunk_size):
+            criteria = {'_id': {'$in': pending[i:i+chunk_size]}, '__active__': True}
+            for doc in cls.__db__[clsname].find(criteria, projection):
+                if cache: cache.put(clsname, doc)
+                key = doc['_id']
+                found[key] = cls.load(doc, fields)
+
+        documents = []
+        missing = []
+        for id, key in zip(ids, keys):
+            if key in found: documents.append(found[key])
+            else: missing.append(id)
+        return documents, missing
+
+    def find_first (cls, criteria, fields=None):
         '''Return the first element matching the provided criteria.'''
 
         criteria['__active__'] = True
         clsname = cls.__name__
-        doc = cls.__db__[clsname].find_one(criteria)
+        cache = cls.__cache__ if fields is None else None
+        if cache:
+            doc = cache.get_query(clsname, criteria)
+            if doc: return cls.load(doc)
+        doc = cls.__db__[clsname].find_one(criteria, cls.get_projection(fields))
         if not doc: raise coconut.error.DocumentNotFound (criteria)
-        obj = cls(doc)
-        obj.flush()
-        return obj
+        if cache: cache.put_query(clsname, criteria, doc)
+        return cls.load(doc, fields)
+
+    def find (cls, criteria={}, limit=None, sort=[], skip=None, fields=None, prefetch=None):
+        '''Get all matching documents.
+
+        prefetch is a list of dotted paths to Links that are dereferenced for
+        all of the documents at once. See coconut.element.prefetch.
+        '''
 
-    def find (cls, criteria={}, limit=None, sort=[]):
-        '''Get all matching documents.'''
+        documents = list(cls.find_iter(criteria, limit=limit, sort=sort, skip=skip, fields=fields))
+        if prefetch: coconut.element.prefetch(documents, prefetch)
+        return documents
+
+    def find_iter (cls, criteria={}, limit=None, sort=[], skip=None, batch_size=None, fields=None):
+        '''Iterate over matching documents as they are read from the cursor.
+
+        Documents are loaded one at a time, so memory use does not grow with
+        the size of the result. batch_size sets the number of documents the
+        cursor fetches from the server per round trip.
+        '''
 
         criteria['__active__'] = True
         clsname = cls.__name__
-        if limit:
-            doclist = cls.__db__[clsname].find(criteria, limit=limit)
+        cursor = cls.__db__[clsname].find(criteria, cls.get_projection(fields))
+        if sort: cursor.sort(*sort)
+        if skip: cursor.skip(skip)
+        if limit: cursor.limit(limit)
+        if batch_size: cursor.batch_size(batch_size)
+        for doc in cursor:
+            yield cls.load(doc, fields)
+
+    def get_projection (cls, fields):
+        '''Return the MongoDB projection for a list of dotted field paths.'''
+
+        if fields is None: return None
+        return dict((path, True) for path in fields)
+
+    def load (cls, doc, fields=None):
+        '''Build a Document from data read from the database.
+
+        The data is trusted, so it is converted by the compiled schema without
+        validation or copy-on-write and the Document is returned flushed.
+
+        If fields is given, doc holds only those dotted paths. Keys that were
+        not loaded are not given default values, and as they are absent from
+        the Document they are not written back when it is saved.
+
+        If a Session is active and already holds the Document, that instance
+        is returned instead. Partially loaded Documents are not registered.
+        '''
+
+        # Dirty hack to resolve cyclic inheritance imports
+        import coconut.revision
+        session = coconut.session.get_session()
+        if session and '_id' in doc:
+            obj = session.get(cls, str(doc['_id']))
+            if obj is not None: return obj
+
+        obj = cls.__new__(cls)
+        Dict.__init__(obj, obj)
+        if fields is not None:
+            obj.__fields__ = coconut.schema.get_projection_tree(fields)
+        if '_id' in doc:
+            obj.id = str(doc.pop('_id'))
         else:
-            doclist = cls.__db__[clsname].find(criteria)
-        if sort: doclist.sort(*sort)
-        objlist = [cls(doc) for doc in doclist]
-        for obj in objlist:
-            obj.flush()
-        return objlist
+            obj.id = None
+        if '__active__' in doc:
+            obj.__active__ = doc.pop('__active__')
+        obj.__plan__.load_items(doc, obj)
+        if session and obj.id and fields is None: session.add(obj)
+        return obj
+
+    def save_all (cls, documents):
+        '''Save many Documents with one unordered bulk write per collection.
+
+        The Revisions for all of the saved Documents are then inserted in a
+        single batch. Documents that violate a unique index are left unsaved
+        while the rest are saved, and a UniqueIndexViolation listing them in
+        its documents attribute is raised at the end. Saved Documents without
+        changes are skipped, as by save. The Revisions of write-behind classes
+        are queued for the background writer instead: see Document.save.
+
+        Returns the list of Documents that were written.
+        '''
+
+        groups = {}
+        written = []
+        for document in documents:
+            ops = {}
+            sets, unsets = document.get_changes(ops)
+            if document.id and not (sets or unsets or ops):
+                document.flush()
+                continue
+            groups.setdefault(type(document), []).append((document, sets, unsets, ops))
+
+        violations = []
+        error = None
+        events = []
+        deferred = []
+        for doctype, group in groups.items():
+            bulk = doctype.__db__[doctype.__name__].initialize_unordered_bulk_op()
+            ids = []
+            for document, sets, unsets, ops in group:
+                if document.id:
+                    bulk.find({'_id':ObjectId(document.id)}).update(document.get_update_query(sets, unsets, ops))
+                    ids.append(document.id)
+                else:
+                    query = document.get_insert_query(sets)
+                    query['_id'] = ObjectId()
+                    bulk.insert(query)
+                    ids.append(str(query['_id']))
+            failed = set()
+            try:
+                bulk.execute()
+            except pymongo.errors.BulkWriteError as e:
+                for write_error in e.details.get('writeErrors', []):
+                    failed.add(write_error['index'])
+                    if write_error.get('code') in (11000, 11001):
+                        violations.append(group[write_error['index']][0])
+                    else:
+                        error = e
+            for i, (document, sets, unsets, ops) in enumerate(group):
+                if i in failed: continue
+                document.id = ids[i]
+                written.append(document)
+                event = document.after_save(sets, unsets, ops)
+                if event and doctype.is_write_behind():
+                    deferred.append(event)
+                elif event:
+                    events.append(event)
+
+        if deferred: coconut.revision.write_behind(deferred)
+        if events: coconut.revision.write(events)
+
+        if error: raise error
+        if violations:
+            raise coconut.error.UniqueIndexViolation('%i documents violated a unique index.' % len(violations), violations)
+        return written
+
+    def is_write_behind (cls):
+        '''Return True if the class's Revisions are written in the background.
+
+        Raises ValueError if __durability__ is neither SYNC nor WRITE_BEHIND.
+        '''
+
+        if cls.__durability__ not in (SYNC, WRITE_BEHIND):
+            raise ValueError('Unknown __durability__ for %s: %r' % (cls.__name__, cls.__durability__))
+        return cls.__durability__ == WRITE_BEHIND
 
     def ensure_indexes (cls):
         '''Ensure indexes defined on the Document schema exist in the database.
 
-        Currently only indexes on top-level keys are supported.
+        Indexes on top-level keys are declared in the schema. Compound indexes
+        are listed in __indexes__, each as a list of (dotted path, direction)
+        pairs. The indexes of the class's Revision collection are ensured as well.
         '''
 
+        # Dirty hack to resolve cyclic inheritance imports
+        import coconut.revision
         clsname = cls.__name__
         for (key,val) in cls.__schema__[dict].items():
             if isinstance(val,dict):
@@ -465,11 +1020,25 @@ class DocumentClass (type):
                 opts = {}
                 if index == 'unique': opts['unique'] = True
                 cls.__db__[clsname].ensure_index(key, **opts)
+        for keys in cls.__indexes__:
+            cls.__db__[clsname].ensure_index(list(keys))
+        revision_class = coconut.revision.get_revision_class(cls)
+        if revision_class and not issubclass(cls, coconut.revision.Revision):
+            revision_class.ensure_indexes()
 
 class Document (Dict):
     __metaclass__ = DocumentClass
     __types__ = {}
     __schema__ = { any: any }
+    __cache__ = None
+    __sparse__ = False
+    __snapshot_interval__ = None
+    __retention__ = None
+    __indexes__ = []
+    __index_paths__ = False
+    __durability__ = SYNC
+    __revision_collection__ = None
+    __revisions__ = None
     
     def __init__ (self, *args, **kwargs):
         # Dirty hack to resolve cyclic inheritance imports
@@ -491,13 +1060,9 @@ class Document (Dict):
         for key,value in data.items():
             self[key] = value
         # Check for default values
-        for key,item_schema in self.__schema__[dict].items():
-            if key == any: continue
+        for key, item_plan in self.__plan__.defaults:
             if key not in self:
-                if isinstance(item_schema,dict) and 'default' in item_schema:
-                    self[key] = copy.deepcopy(item_schema['default'])
-                else:
-                    self[key] = None
+                self[key] = item_plan.get_default()
 
     def __repr__ (self):
         return '%s(%s)' % (type(self).__name__,Dict.__repr__(self))
@@ -520,29 +1085,172 @@ class Document (Dict):
     # Database operations
 
     def save (self):
-        sets, unsets = self.get_changes()
-        query = {'$set': sets.copy(), '$unset': unsets.copy()}
+        '''Write the Document's changes to the database and record a Revision.
+
+        A saved Document without changes is not written and gets no Revision.
+        Returns True if the Document was written, False otherwise.
+
+        If the class sets __durability__ to WRITE_BEHIND, the Revision is
+        queued for a background thread to insert instead of being written
+        before save returns. Call coconut.revision.flush_revisions to wait
+        for queued Revisions to be written.
+        '''
+
+        ops = {}
+        sets, unsets = self.get_changes(ops)
+        if self.id and not (sets or unsets or ops):
+            self.flush()
+            return False
         clsname = type(self).__name__
         try:
             if self.id:
-                self.__db__[clsname].update({'_id':ObjectId(self.id)}, query)
+                self.__db__[clsname].update({'_id':ObjectId(self.id)}, self.get_update_query(sets, unsets, ops))
             else:
-                query['$set']['__active__'] = True
-                docid = self.__db__[clsname].insert(query['$set'])
+                docid = self.__db__[clsname].insert(self.get_insert_query(sets))
                 self.id = str(docid)
         except pymongo.errors.DuplicateKeyError as e:
             raise coconut.error.UniqueIndexViolation(str(e))
 
-        self.flush()
-        event_query = {'set': sets.copy(), 'unset': unsets.copy()}
         # Write change event
-        if isinstance(self,coconut.revision.Revision): return
-        event = coconut.revision.Revision(item=self,changes=event_query,date=time.time())
-        event.save()
+        event = self.after_save(sets, unsets, ops)
+        if event and type(self).is_write_behind():
+            coconut.revision.write_behind([event])
+        elif event:
+            coconut.revision.write([event])
+        return True
+
+    def get_changes (self, ops=None):
+        '''Recursively generate and return a list of unsaved changes.
+
+        If the Document class sets __sparse__, keys of dicts whose values are
+        None or equal to their schema defaults are unset rather than set, and
+        are left out of values that are set whole. They are filled in from the
+        schema again when the Document is loaded. Lists updated with array
+        operators are unset if they are left at their defaults, and set whole
+        if their items would be pruned.
+        '''
+
+        sets, unsets = Dict.get_changes(self, ops)
+        if not self.__sparse__: return sets, unsets
+        for operator, paths in (ops or {}).items():
+            for path in paths.keys():
+                value = coconut.schema.Schema.export_element(self.get_element(path))
+                parent_plan, item_plan = coconut.schema.resolve_path(self.__plan__, path)
+                if isinstance(parent_plan, coconut.schema.DictPlan) and item_plan.is_default(value):
+                    del paths[path]
+                    if self.id: unsets[path] = ''
+                elif item_plan.prune(value) != value:
+                    del paths[path]
+                    sets[path] = item_plan.prune(value)
+            if not paths: del ops[operator]
+        for path, value in sets.items():
+            parent_plan, item_plan = coconut.schema.resolve_path(self.__plan__, path)
+            if isinstance(parent_plan, coconut.schema.DictPlan) and item_plan.is_default(value):
+                del sets[path]
+                if self.id: unsets[path] = ''
+            else:
+                sets[path] = item_plan.prune(value)
+        return sets, unsets
+
+    def get_element (self, path):
+        '''Return the element at a dotted path, as used in get_changes.'''
+
+        element = self
+        for term in path.split('.'):
+            element = element[int(term) if isinstance(element, list) else term]
+        return element
+
+    def get_update_query (self, sets, unsets, ops=None):
+        '''Return the update operation for a saved Document's changes.
+
+        ops maps array update operators such as $push to their paths, as
+        generated by get_changes. Empty operators are left out.
+        '''
+
+        query = {}
+        if sets: query['$set'] = sets.copy()
+        if unsets: query['$unset'] = unsets.copy()
+        for operator, paths in (ops or {}).items():
+            if paths: query[operator] = paths.copy()
+        # An update without operators would replace the whole document
+        if not query: query['$set'] = {}
+        return query
+
+    def get_insert_query (self, sets):
+        '''Return the database representation of a new Document.'''
+
+        query = sets.copy()
+        query['__active__'] = True
+        return query
+
+    def after_save (self, sets, unsets, ops=None):
+        '''Flush the Document once its changes are written.
+
+        Returns the unsaved Revision recording the changes, or None if the
+        Document is itself a Revision or its class is not revisioned: see
+        coconut.revision.get_revision_class. Array updates are recorded under
+        the name of their operator without the $, e.g. 'push', and the lists
+        they leave are recorded under 'set' too so that History sees them.
+        Only the paths listed under 'paths' were actually set.
+        '''
+
+        clsname = type(self).__name__
+        self.flush()
+        if self.__cache__: self.__cache__.invalidate(clsname, self.id)
+        session = coconut.session.get_session()
+        if session and self.__fields__ is None: session.add(self)
+        if isinstance(self,coconut.revision.Revision): return None
+        revision_class = coconut.revision.get_revision_class(type(self))
+        if revision_class is None: return None
+        recorded = dict(sets)
+        event_query = {
+            'unset': coconut.revision.expand_paths(unsets),
+            'paths': sorted(sets),
+        }
+        for operator, paths in (ops or {}).items():
+            event_query[operator.lstrip('$')] = coconut.revision.expand_paths(
+                dict((path, coconut.revision.strip_modifiers(value)) for path, value in paths.items()))
+            for path in paths:
+                recorded[path] = coconut.schema.Schema.export_element(self.get_element(path))
+        event_query['set'] = coconut.revision.expand_paths(recorded)
+        if self.needs_snapshot():
+            snapshot = self.__plan__.export_element(self)
+            if self.__sparse__: snapshot = self.__plan__.prune(snapshot)
+            event_query['snapshot'] = snapshot
+        if self.__index_paths__:
+            fields = sorted(coconut.revision.get_field_paths(event_query['set']))
+            return revision_class(item=self,changes=event_query,date=time.time(),fields=fields)
+        return revision_class(item=self,changes=event_query,date=time.time())
+
+    def needs_snapshot (self):
+        '''Return True if the next Revision should hold a snapshot of the Document.
+
+        If the class sets __snapshot_interval__ to N, every Nth Revision of a
+        Document records its whole state, so that get_as_of never replays
+        more than N-1 changes. The count is read from the database the first
+        time, then kept on the instance. Partially loaded Documents are never
+        snapshotted.
+        '''
+
+        if not self.__snapshot_interval__ or self.__fields__ is not None: return False
+        if self.__revisions__ is None:
+            self.__revisions__ = coconut.revision.count_since_snapshot(type(self), self.id)
+        self.__revisions__ += 1
+        if self.__revisions__ < self.__snapshot_interval__: return False
+        self.__revisions__ = 0
+        return True
+
+    def at (self, timestamp):
+        '''Return the Document as it was at a time. See DocumentClass.get_as_of.'''
+
+        return type(self).get_as_of(self.id, timestamp)
 
     def remove (self):
         clsname = type(self).__name__
-        self.__db__[clsname].update ({'_id':self.id},{'$set':{'__active__':False}})
+        session = coconut.session.get_session()
+        if session: session.discard(self)
+        if self.__cache__: self.__cache__.invalidate(clsname, self.id)
+        self.__db__[clsname].update ({'_id':ObjectId(self.id)},{'$set':{'__active__':False}})
         self.id = None
 
     def export (self):
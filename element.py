@@ -30,6 +30,42 @@ class JSONElementEncoder (json.JSONEncoder):
             pass
         return json.JSONEncoder.default(self, o)
 
+def prefetch (documents, paths):
+    '''Dereference the Links at dotted paths in many documents at once.
+
+    Links are collected from every document at each path, looking inside
+    lists along the way, and grouped by target type. Each type is then
+    fetched with a single batched query and the Link documents filled in, so
+    that dereferencing them later does not query the database.
+    '''
+
+    links = []
+    for document in documents:
+        for path in paths:
+            collect_links(document, path.split('.'), links)
+
+    targets = {}
+    for link in links:
+        if link.document is not None or link.type == any: continue
+        targets.setdefault(link.type, []).append(link)
+
+    for doctype, group in targets.items():
+        found, missing = doctype.get_many([link.targetid for link in group])
+        found = dict((document.id, document) for document in found)
+        for link in group:
+            link.document = found.get(str(link.targetid))
+
+def collect_links (element, terms, links):
+    '''Append the Links found at a path below element to links.'''
+
+    if isinstance(element, Link):
+        if not terms: links.append(element)
+    elif isinstance(element, list):
+        for item in element:
+            collect_links(item, terms, links)
+    elif terms and isinstance(element, dict) and terms[0] in element:
+        collect_links(element[terms[0]], terms[1:], links)
+
 #
 # Reference Types
 #
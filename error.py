@@ -42,7 +42,10 @@ class ValidationListError (ValidationError):
     pass
 
 class UniqueIndexViolation (ValidationError):
-    pass
+    def __init__ (self, message, documents=None):
+        ValidationError.__init__(self, message)
+        self.message = message
+        self.documents = documents or []
 
 #
 # Schema Errors
@@ -5,28 +5,39 @@ Distributed under the MIT license, see LICENSE file for details.
 '''
 
 class Element (object):
-    '''Wrapper base class for basic types and references.'''
-    pass
+    '''Wrapper base class for basic types and references.
+
+    Containers store scalars as native str, int and float values. The scalar
+    Element types below are kept for code that creates them explicitly, and
+    have no per-instance __dict__.
+    '''
+
+    __slots__ = ()
 
 #
 # Primitive types
 #
 
 class Str (Element, str):
+    __slots__ = ()
+
     def __init__ (self, value):
         Element.__init__ (self)
         str.__init__(self, value)
 
 class Int (Element, int):
+    __slots__ = ()
+
     def __init__ (self, value):
         Element.__init__ (self)
         int.__init__(self, value)
 
 class Float (Element, float):
+    __slots__ = ()
+
     def __init__ (self, value):
         Element.__init__ (self)
         float.__init__(self, value)
 
 class Timestamp (Int):
-    pass
-
+    __slots__ = ()
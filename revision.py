@@ -4,62 +4,784 @@ Author: Luke Williams <shmookey@shmookey.net>
 Distributed under the MIT license, see LICENSE file for details.
 '''
 
+import atexit, datetime, itertools, Queue, threading, time
+
 import coconut.container
 
 import pymongo
+from bson.objectid import ObjectId
+
+# Values of Document.__durability__
+SYNC = coconut.container.SYNC
+WRITE_BEHIND = coconut.container.WRITE_BEHIND
+
+# Recognise the operands of array updates in a tree of recorded changes
+LEAVES = {
+    'push': lambda value: 'each' in value,
+    'pull': lambda value: 'in' in value,
+}
+
+# Checkpoint periods that may be named in a __retention__ policy, in seconds
+PERIODS = {
+    'daily':  24*60*60,
+    'weekly': 7*24*60*60,
+}
+
+def expand_paths (paths):
+    '''Return the dotted paths of an update as a tree of nested dicts.
+
+    Revisions record changes as a tree so that History can follow a field
+    through revisions that set it whole as well as those that set subkeys.
+    '''
+
+    tree = {}
+    for path, value in paths.items():
+        terms = path.split('.')
+        node = tree
+        for term in terms[:-1]:
+            node = node.setdefault(term, {})
+        node[terms[-1]] = value
+    return tree
+
+def strip_modifiers (value):
+    '''Return an update operand with the $ removed from its modifiers.
+
+    Keys starting with $ cannot be stored, so {'$each': [...]} is recorded in
+    a Revision as {'each': [...]}.
+    '''
+
+    if not isinstance(value, dict): return value
+    return dict((key.lstrip('$'), item) for key, item in value.items())
+
+class RevisionWriter (object):
+    '''Inserts the Revisions of write-behind Document classes in the background.
+
+    Revisions are put on a queue holding at most maxsize of them, and put
+    blocks while it is full so that saving cannot outrun the database. A
+    daemon thread, started with the first put, takes up to batch_size
+    Revisions from the queue at a time and inserts them with one insert per
+    collection. Errors raised by the inserts or by subscribers to the
+    notifier are kept, without stopping the thread, and re-raised by flush.
+    '''
+
+    def __init__ (self, maxsize=10000, batch_size=500):
+        self.queue = Queue.Queue(maxsize)
+        self.batch_size = batch_size
+        self.errors = []
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def put (self, collection, query):
+        '''Queue the insert query of a Revision, blocking while the queue is full.'''
+
+        self.start()
+        self.queue.put((collection, query))
+
+    def start (self):
+        '''Start the writer thread if it is not running.'''
+
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive(): return
+            self.thread = threading.Thread(target=self.run, name='coconut-revision-writer')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def run (self):
+        while True:
+            items = [self.queue.get()]
+            while len(items) < self.batch_size:
+                try:
+                    items.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            try:
+                self.write(items)
+            except Exception as e:
+                self.errors.append(e)
+            finally:
+                for item in items: self.queue.task_done()
+
+    def write (self, items):
+        '''Insert a batch of queued Revisions, grouped by collection.
+
+        A failed insert or subscriber is recorded in errors without stopping
+        the rest of the batch.
+        '''
+
+        batches = {}
+        for collection, query in items:
+            batches.setdefault(collection.full_name, (collection, []))[1].append(query)
+        for collection, queries in batches.values():
+            try:
+                collection.insert(queries)
+            except Exception as e:
+                self.errors.append(e)
+                continue
+            for query in queries:
+                try:
+                    notifier.notify(query)
+                except Exception as e:
+                    self.errors.append(e)
+
+    def flush (self):
+        '''Block until every queued Revision is written, then raise any error.'''
+
+        self.queue.join()
+        if self.errors:
+            errors, self.errors = self.errors, []
+            raise errors[0]
+
+# The writer used by write_behind. Replace it before saving anything to
+# change its queue size or batch size.
+writer = RevisionWriter()
+
+def write (events):
+    '''Insert unsaved Revisions with one insert per collection.
+
+    Subscribers to the notifier are told of each Revision once it is written.
+    '''
+
+    batches = {}
+    for event in events:
+        batches.setdefault(type(event), []).append(event)
+    for revision_class, batch in batches.items():
+        queries = [event.get_insert_query(event.get_changes()[0]) for event in batch]
+        eventids = revision_class.__db__[revision_class.__name__].insert(queries)
+        for event, eventid in zip(batch, eventids):
+            event.id = str(eventid)
+            event.flush()
+        for query in queries: notifier.notify(query)
+
+def write_behind (events):
+    '''Queue unsaved Revisions to be inserted by the background writer.'''
+
+    for event in events:
+        collection = event.__db__[type(event).__name__]
+        writer.put(collection, event.get_insert_query(event.get_changes()[0]))
+
+def flush_revisions ():
+    '''Wait for the background writer to insert every queued Revision.
+
+    Call this before reading the history of write-behind Documents, e.g. in
+    tests. It is called when the interpreter exits.
+    '''
+
+    writer.flush()
+
+atexit.register(flush_revisions)
+
+def flatten_paths (tree, is_leaf=None, prefix=None):
+    '''Return a tree of nested dicts as a dict of dotted paths, undoing expand_paths.
+
+    Dicts for which is_leaf returns True are taken as values, not subtrees.
+    '''
+
+    paths = {}
+    for key, value in tree.items():
+        path = '%s.%s' % (prefix, key) if prefix else key
+        if isinstance(value, dict) and value and not (is_leaf and is_leaf(value)):
+            paths.update(flatten_paths(value, is_leaf, path))
+        else:
+            paths[path] = value
+    return paths
+
+def get_field_paths (tree, prefix=None):
+    '''Return the dotted paths of every node in a tree of nested dicts.
+
+    Unlike flatten_paths, the paths of subtrees are included as well as those
+    of their leaves, so that a field set whole or by subkey matches either.
+    '''
+
+    paths = []
+    for key, value in tree.items():
+        path = '%s.%s' % (prefix, key) if prefix else key
+        paths.append(path)
+        if isinstance(value, dict): paths.extend(get_field_paths(value, path))
+    return paths
+
+def get_path (tree, path):
+    '''Return the value at a dotted path in a tree of nested dicts.'''
+
+    for term in path.split('.'):
+        tree = tree[term]
+    return tree
+
+def find_parent (state, path, create=False):
+    '''Return the container holding a dotted path in a raw document and its key.
+
+    List indices are converted to ints. If create is set, missing dicts on the
+    way are added, as by MongoDB. Returns (None, None) if the path is missing.
+    '''
+
+    terms = path.split('.')
+    node = state
+    for term in terms[:-1]:
+        if isinstance(node, list):
+            index = int(term)
+            if index >= len(node): return None, None
+            node = node[index]
+        elif term in node or create:
+            node = node.setdefault(term, {})
+        else:
+            return None, None
+        if not isinstance(node, (dict, list)): return None, None
+    if isinstance(node, list): return node, int(terms[-1])
+    return node, terms[-1]
+
+def apply_changes (state, changes):
+    '''Apply the changes recorded by a Revision to a raw document in place.
+
+    Set paths are taken from changes['paths'] when the Revision lists them, so
+    that a dict set whole replaces the old one rather than being merged in.
+    A Revision holding a snapshot replaces the state with it. The snapshot
+    is True for checkpoints written by compaction, whose sets are the state.
+    '''
+
+    if 'snapshot' in changes:
+        snapshot = changes['snapshot']
+        if snapshot is True: snapshot = changes['set']
+        state.clear()
+        state.update(snapshot)
+        return state
+    sets = changes.get('set', {})
+    paths = changes.get('paths')
+    if paths is None: paths = flatten_paths(sets).keys()
+    for path in paths:
+        node, key = find_parent(state, path, create=True)
+        if node is None: continue
+        if isinstance(node, list):
+            node.extend([None] * (key + 1 - len(node)))
+        node[key] = get_path(sets, path)
+    for path in flatten_paths(changes.get('unset', {})):
+        node, key = find_parent(state, path)
+        if isinstance(node, list):
+            if key < len(node): node[key] = None
+        elif node is not None:
+            node.pop(key, None)
+    for path, update in flatten_paths(changes.get('push', {}), LEAVES['push']).items():
+        node, key = find_parent(state, path, create=True)
+        if node is None: continue
+        items = node.setdefault(key, []) if isinstance(node, dict) else node[key]
+        position = update.get('position', len(items))
+        items[position:position] = update['each']
+        if 'slice' in update:
+            length = update['slice']
+            items[:] = items[length:] if length < 0 else items[:length]
+    for path, direction in flatten_paths(changes.get('pop', {})).items():
+        node, key = find_parent(state, path)
+        if node is None: continue
+        items = node[key]
+        if items: items.pop(0 if direction < 0 else -1)
+    for path, value in flatten_paths(changes.get('pull', {}), LEAVES['pull']).items():
+        node, key = find_parent(state, path)
+        if node is None: continue
+        if isinstance(value, dict): values = value['in']
+        else: values = [value]
+        node[key] = [item for item in node[key] if item not in values]
+    return state
+
+# Revision classes created for the collections named by __revision_collection__
+revision_classes = {}
+
+def get_revision_class (cls):
+    '''Return the Revision class for a Document class, or None if it is not revisioned.
+
+    Revisions are routed by the class's __revision_collection__ setting:
+     None -- The shared Revision collection.
+     True -- A collection of its own, named e.g. Person__revisions.
+     A name -- The collection of that name, which classes may share.
+     False -- No Revisions are recorded.
+    Each collection has a subclass of Revision of the same name.
+    '''
+
+    name = getattr(cls, '__revision_collection__', None)
+    if name is False: return None
+    if name is None or name == Revision.__name__: return Revision
+    if name is True: name = '%s__revisions' % cls.__name__
+    revision_class = revision_classes.get(name)
+    if revision_class is None:
+        revision_class = type(Revision)(name, (Revision,), {'__doc__': Revision.__doc__})
+        revision_classes[name] = revision_class
+    return revision_class
+
+def get_collection (cls):
+    '''Return the collection holding the Revisions of a Document class, or None.'''
+
+    revision_class = get_revision_class(cls)
+    if revision_class is None: return None
+    return revision_class.__db__[revision_class.__name__]
+
+def get_state (cls, item_id, timestamp, batch_size=100):
+    '''Return the raw state of a Document at a time by replaying its Revisions.
+
+    Replay starts from the latest snapshot recorded at or before timestamp,
+    so at most __snapshot_interval__ Revisions are applied when snapshots
+    are enabled. Returns None if the Document had no Revisions by then.
+    '''
+
+    collection = get_collection(cls)
+    if collection is None: return None
+    query = {
+        'item.$id': item_id,
+        '__active__': True,
+        'date': {'$lte': timestamp},
+    }
+    snapshot_query = dict(query)
+    snapshot_query['changes.snapshot'] = {'$exists':True}
+    snapshot = collection.find_one(snapshot_query, {'date': True, 'changes': True},
+        sort=[('date', pymongo.DESCENDING), ('_id', pymongo.DESCENDING)])
+    state = None
+    if snapshot is not None:
+        state = apply_changes({}, snapshot['changes'])
+        query['date'] = {'$gt': snapshot['date'], '$lte': timestamp}
+    cursor = collection.find(query, {'changes': True})
+    cursor.sort([('date', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)])
+    cursor.batch_size(batch_size)
+    for revision in cursor:
+        if state is None: state = {}
+        apply_changes(state, revision['changes'])
+    return state
+
+def count_since_snapshot (cls, item_id):
+    '''Return the number of Revisions of a Document since its latest snapshot.'''
+
+    collection = get_collection(cls)
+    query = {'item.$id': item_id, '__active__': True}
+    snapshot_query = dict(query)
+    snapshot_query['changes.snapshot'] = {'$exists':True}
+    snapshot = collection.find_one(snapshot_query, {'date': True}, sort=[('date', pymongo.DESCENDING)])
+    if snapshot is not None:
+        query['date'] = {'$gt': snapshot['date']}
+    return collection.find(query).count()
+
+def compact_iter (cls, now=None, after=None, batch_size=100):
+    '''Compact the old Revisions of a Document class by its __retention__ policy.
+
+    The policy is a dict declared on the class next to __schema__:
+     age -- Revisions older than this many seconds are compacted.
+     checkpoint -- 'daily', 'weekly' or a period in seconds to keep one
+       checkpoint per period, or None to squash all of the old Revisions of
+       a Document into a single one.
+
+    Documents are compacted one at a time, in order of ID, from a cursor
+    reading batch_size Revisions per round trip, and yields (id, count) with
+    the number of Revisions each one had replaced. Stop whenever you like and
+    pass the last id as after to resume from the next Document.
+    '''
+
+    policy = cls.__retention__
+    collection = get_collection(cls)
+    if not policy or collection is None: return
+    period = policy.get('checkpoint')
+    period = PERIODS.get(period, period)
+    cutoff = (now or time.time()) - policy['age']
+    query = {
+        'item.$ref': cls.__name__,
+        '__active__': True,
+        'date': {'$lt': cutoff},
+    }
+    if after is not None: query['item.$id'] = {'$gt': after}
+    cursor = collection.find(query)
+    cursor.sort([('item.$id', pymongo.ASCENDING), ('date', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)])
+    cursor.batch_size(batch_size)
+    for item_id, revisions in itertools.groupby(cursor, lambda revision: revision['item'].id):
+        yield item_id, compact_revisions(collection, revisions, period, batch_size)
+
+def compact (cls, now=None, batch_size=100):
+    '''Compact the old Revisions of a Document class and return how many were replaced.
+
+    See compact_iter.
+    '''
+
+    return sum(count for item_id, count in compact_iter(cls, now, batch_size=batch_size))
+
+def compact_revisions (collection, revisions, period=None, batch_size=100):
+    '''Replace a Document's Revisions, in date order, with checkpoints.
+
+    The Revisions must run from the Document's first. Those falling in the
+    same period are replaced by one checkpoint holding the state after the
+    last of them, or all of them if period is None. A Revision that is alone
+    in its period is left as it is. Returns the number of Revisions replaced.
+    '''
+
+    state = {}
+    bucket = []
+    bucket_key = last = None
+    count = 0
+    for revision in revisions:
+        key = int(revision['date'] // period) if period else None
+        if bucket and key != bucket_key:
+            count += write_checkpoint(collection, last, state, bucket, batch_size)
+            bucket = []
+        apply_changes(state, revision['changes'])
+        bucket.append(revision['_id'])
+        bucket_key, last = key, revision
+    if bucket:
+        count += write_checkpoint(collection, last, state, bucket, batch_size)
+    return count
+
+def write_checkpoint (collection, revision, state, ids, batch_size=100):
+    '''Replace the Revisions with the given ids by a checkpoint of the state.
+
+    The checkpoint takes the date of the last Revision it replaces, and is
+    inserted before they are removed so that the history is never missing
+    a state. A checkpoint left beside them by an interruption is replayed
+    after them, as replay orders Revisions of the same date by _id.
+    '''
+
+    if len(ids) < 2: return 0
+    checkpoint = {
+        'item': revision['item'],
+        'changes': {'set': state, 'unset': {}, 'snapshot': True},
+        'date': revision['date'],
+        '__active__': True,
+    }
+    if 'fields' in revision: checkpoint['fields'] = sorted(get_field_paths(state))
+    collection.insert(checkpoint)
+    for i in range(0, len(ids), batch_size):
+        collection.remove({'_id': {'$in': ids[i:i+batch_size]}})
+    return len(ids)
+
+def get_changed_paths (changes):
+    '''Return the dotted paths changed by the changes recorded in a Revision.'''
+
+    paths = []
+    for operator, tree in changes.items():
+        if operator in ('paths', 'snapshot'): continue
+        paths.extend(flatten_paths(tree, LEAVES.get(operator)))
+    return paths
+
+def match_paths (paths, fields):
+    '''Return True if any path is one of fields, or a subkey or parent of one.'''
+
+    for path in paths:
+        for field in fields:
+            if path == field or path.startswith(field + '.') or field.startswith(path + '.'):
+                return True
+    return False
+
+def make_event (revision):
+    '''Return the change event for a Revision as stored in the database.
+
+    Events are dicts with the keys:
+     token -- The position of the event, which may be passed to watch as since.
+     type -- The name of the Document class.
+     id -- The ID of the Document.
+     date -- The date of the Revision.
+     changes -- The changes recorded by the Revision.
+    '''
+
+    return {
+        'token':   str(revision['_id']),
+        'type':    revision['item'].collection,
+        'id':      str(revision['item'].id),
+        'date':    revision['date'],
+        'changes': revision['changes'],
+    }
+
+class Notifier (object):
+    '''Delivers the change events of this process to subscribers as they happen.
+
+    Each Revision is passed to the matching subscribers as soon as it has been
+    inserted, without reading it back from the database. Callbacks are called
+    in the thread that inserted the Revision, which is the background writer
+    for write-behind classes, and should not raise.
+    '''
+
+    def __init__ (self):
+        self.subscriptions = []
+        self.lock = threading.Lock()
+
+    def subscribe (self, callback, doc_classes=None, fields=None):
+        '''Call callback with each event for the Document classes, or for all of them.
+
+        If fields is given, only events changing one of those dotted paths, one
+        of their subkeys or one of their parents are delivered. Returns the
+        subscription, to be passed to unsubscribe.
+        '''
+
+        names = None
+        if doc_classes is not None: names = set(cls.__name__ for cls in doc_classes)
+        subscription = (callback, names, fields)
+        with self.lock:
+            self.subscriptions = self.subscriptions + [subscription]
+        return subscription
+
+    def unsubscribe (self, subscription):
+        with self.lock:
+            self.subscriptions = [s for s in self.subscriptions if s is not subscription]
+
+    def notify (self, revision):
+        '''Deliver a newly inserted Revision to the matching subscribers.'''
+
+        if not self.subscriptions: return
+        event = make_event(revision)
+        for callback, names, fields in self.subscriptions:
+            if names is not None and event['type'] not in names: continue
+            if fields and not match_paths(get_changed_paths(event['changes']), fields): continue
+            callback(event)
+
+notifier = Notifier()
+
+def subscribe (callback, doc_classes=None, fields=None):
+    '''Subscribe to the change events of this process. See Notifier.subscribe.'''
+
+    return notifier.subscribe(callback, doc_classes, fields)
+
+def unsubscribe (subscription):
+    notifier.unsubscribe(subscription)
+
+def watch (doc_classes, since=None, fields=None, follow=True, interval=1.0, batch_size=100):
+    '''Return a generator of the change events of Document classes, read by polling.
+
+    Events are yielded in the order their Revisions were inserted, starting
+    after since: the token of an earlier event, a timestamp, or None to
+    start from the latest Revision. Keep the token of the last event handled
+    to resume from it later. fields filters the events as in
+    Notifier.subscribe.
+
+    Once the events are caught up, the collections are polled every interval
+    seconds, or the generator returns if follow is False. The order is that
+    of the ObjectIds of the Revisions, so Revisions inserted by different
+    processes within the same second may be yielded in either order.
+
+    The starting position is read when watch is called, not when the first
+    event is requested.
+    '''
+
+    collections = {}
+    for cls in doc_classes:
+        collection = get_collection(cls)
+        if collection is None: continue
+        collections.setdefault(collection.full_name, (collection, []))[1].append(cls.__name__)
+    collections = collections.values()
+
+    if since is None:
+        token = None
+        for collection, names in collections:
+            latest = collection.find_one({'item.$ref': {'$in': names}}, {'_id': True},
+                sort=[('_id', pymongo.DESCENDING)])
+            if latest is not None and (token is None or latest['_id'] > token):
+                token = latest['_id']
+    elif isinstance(since, (int, long, float)):
+        token = ObjectId.from_datetime(datetime.datetime.utcfromtimestamp(since))
+    else:
+        token = ObjectId(since)
+    return poll_events(collections, token, fields, follow, interval, batch_size)
+
+def poll_events (collections, token, fields=None, follow=True, interval=1.0, batch_size=100):
+    '''Generate the change events of Revisions after token. See watch.
+
+    collections is a list of (collection, Document class names) pairs.
+    '''
+
+    while True:
+        revisions = []
+        bound = None
+        for collection, names in collections:
+            query = {'item.$ref': {'$in': names}, '__active__': True}
+            if token is not None: query['_id'] = {'$gt': token}
+            batch = list(collection.find(query).sort('_id', pymongo.ASCENDING).limit(batch_size))
+            revisions.extend(batch)
+            # Later Revisions in this collection may precede those in others
+            if len(batch) == batch_size and (bound is None or batch[-1]['_id'] < bound):
+                bound = batch[-1]['_id']
+        revisions.sort(key=lambda revision: revision['_id'])
+        if bound is not None:
+            revisions = [revision for revision in revisions if revision['_id'] <= bound]
+        for revision in revisions:
+            token = revision['_id']
+            event = make_event(revision)
+            if fields and not match_paths(get_changed_paths(event['changes']), fields): continue
+            yield event
+        if revisions: continue
+        if not follow: return
+        time.sleep(interval)
 
 class History (object):
-    def __init__ (self, document, field):
+    '''An iterator over the revisions of a Document or one of its keys.
+
+    Revisions are read from a single sorted cursor, newest first unless
+    ascending is set, and each step yields the raw value recorded for the
+    field rather than a Revision Document. start and end bound the revision
+    dates (start inclusive, end exclusive) and batch_size sets how many
+    revisions the cursor fetches per round trip.
+
+    A History can be reversed with reversed() and sliced, e.g. history[10:20],
+    each of which returns a new History over the same revisions.
+    '''
+
+    def __init__ (self, document, field=None, ascending=False, start=None, end=None,
+                  batch_size=100, skip=0, limit=None):
         self.document = document
         self.field = field
+        self.ascending = ascending
+        self.start = start
+        self.end = end
+        self.batch_size = batch_size
+        self.skip = skip
+        self.limit = limit
         self.current = None
+        self.cursor = None
         if field: self.path = field.split('.')
         else: self.path = None
 
     def __iter__ (self):
         return self
 
-    def next (self):
-        query = {
-            'item.$id': self.document.id,
+    def __reversed__ (self):
+        '''Return a History over the same revisions in the opposite order.
+
+        A sliced History is re-anchored from the other end, which takes a
+        count of the revisions.
+        '''
+
+        if not self.skip and self.limit is None:
+            return self.copy(ascending=not self.ascending)
+        collection = self.get_collection()
+        total = collection.find(self.get_query()).count() if collection is not None else 0
+        end = total if self.limit is None else min(self.skip + self.limit, total)
+        return self.copy(ascending=not self.ascending, skip=total - end,
+            limit=max(end - self.skip, 0))
+
+    def __getitem__ (self, index):
+        '''Return a History over a slice of this one, or a single value.'''
+
+        if isinstance(index, slice):
+            if index.step not in (None, 1):
+                raise ValueError('History slices do not support a step')
+            start, stop = index.start or 0, index.stop
+            if start < 0 or (stop is not None and stop < 0):
+                raise ValueError('History slices do not support negative indices')
+            limit = self.limit
+            if stop is not None:
+                limit = max(stop - start, 0)
+                if self.limit is not None: limit = min(limit, max(self.limit - start, 0))
+            elif limit is not None:
+                limit = max(limit - start, 0)
+            return self.copy(skip=self.skip+start, limit=limit)
+        collection = self.get_collection()
+        if collection is None or index < 0 or (self.limit is not None and index >= self.limit):
+            raise IndexError('History index out of range')
+        revision = collection.find_one(self.get_query(),
+            self.get_projection(), sort=[self.get_sort()], skip=self.skip+index)
+        if revision is None:
+            raise IndexError('History index out of range')
+        return self.get_component(revision)
+
+    def copy (self, **options):
+        '''Return a new History with the same options, updated by options.'''
+
+        settings = {
+            'ascending': self.ascending, 'start': self.start, 'end': self.end,
+            'batch_size': self.batch_size, 'skip': self.skip, 'limit': self.limit,
         }
-        if self.current:
-            query['date'] = {'$lt':self.current.date}
-        if self.field: query['changes.set.%s' % self.field] = {'$exists':True}
-        revisions = coconut.revision.Revision.find(query, sort=('date',pymongo.DESCENDING), limit=1)
-        if not revisions:
+        settings.update(options)
+        return History(self.document, self.field, **settings)
+
+    def next (self):
+        if self.limit == 0 or self.get_collection() is None:
             raise StopIteration()
-        self.current = revisions[0]
-        component = self.current.changes['set']
-        if not self.path: return component
-        for term in self.path:
-            component = component[term]
-        return component
+        if self.cursor is None:
+            self.cursor = self.get_cursor()
+        self.current = self.cursor.next()
+        return self.get_component(self.current)
 
     def first (self):
         '''Point the iterator at the first chronological revision and return it.'''
 
+        collection = self.get_collection()
+        if collection is None:
+            raise StopIteration()
+        revision = collection.find_one(self.get_query(), self.get_projection(),
+            sort=[('date', pymongo.ASCENDING)])
+        if revision is None:
+            raise StopIteration()
+        self.current = revision
+        self.cursor = None
+        return self.get_component(revision)
+
+    def get_collection (self):
+        '''Return the collection holding the Revisions, or None if there are none.'''
+
+        return get_collection(type(self.document))
+
+    def get_query (self):
+        '''Return the criteria matching the revisions in the History.'''
+
         query = {
             'item.$id': self.document.id,
+            '__active__': True,
         }
-        if self.field:
+        if self.field and getattr(self.document, '__index_paths__', False):
+            # Revisions recorded before __index_paths__ was set have no fields
+            query['$or'] = [
+                {'fields': self.field},
+                {'fields': None, 'changes.set.%s' % self.field: {'$exists':True}},
+            ]
+        elif self.field:
             query['changes.set.%s' % self.field] = {'$exists':True}
-        revisions = coconut.revision.Revision.find(query, sort=('date',pymongo.ASCENDING), limit=1)
-        self.current = revisions[0]
-        component = self.current.changes['set']
+        date = {}
+        if self.start is not None: date['$gte'] = self.start
+        if self.end is not None: date['$lt'] = self.end
+        if date: query['date'] = date
+        return query
+
+    def get_projection (self):
+        '''Return the projection reading only the recorded field.'''
+
+        if self.field: return {'date': True, 'changes.set.%s' % self.field: True}
+        return {'date': True, 'changes.set': True}
+
+    def get_sort (self):
+        if self.ascending: return ('date', pymongo.ASCENDING)
+        return ('date', pymongo.DESCENDING)
+
+    def get_cursor (self):
+        '''Open the cursor, continuing past the current revision if there is one.'''
+
+        query = self.get_query()
+        if self.current is not None:
+            date = query.setdefault('date', {})
+            if self.ascending: date['$gt'] = self.current['date']
+            else: date['$lt'] = self.current['date']
+        cursor = self.get_collection().find(query, self.get_projection())
+        cursor.sort(*self.get_sort())
+        if self.skip: cursor.skip(self.skip)
+        if self.limit is not None: cursor.limit(self.limit)
+        if self.batch_size: cursor.batch_size(self.batch_size)
+        return cursor
+
+    def get_component (self, revision):
+        '''Return the value recorded for the field by a raw revision.'''
+
+        component = revision['changes']['set']
         if not self.path: return component
         for term in self.path:
             component = component[term]
         return component
-        
+
 
 class Revision (coconut.container.Document):
-    '''A change event to a document.'''
+    '''A change event to a document.
+
+    If the Document class sets __index_paths__, fields lists the dotted paths
+    of everything set by the change and its subkeys, which History queries
+    through the (item.$id, fields, date) index instead of changes.set.
+    Revisions are sparse, so fields is left out of those of other classes.
+    '''
 
+    __sparse__ = True
     __schema__ = {dict:{
       'item':    { id:    any },
       'changes': { dict:  any, 'traverse':False },
       'date':    { float: any, 'index':True },
+      'fields':  { list: [ { str: any } ], range: all },
     }}
+    __indexes__ = [
+        [('item.$id', pymongo.ASCENDING), ('date', pymongo.ASCENDING)],
+        [('item.$id', pymongo.ASCENDING), ('fields', pymongo.ASCENDING), ('date', pymongo.ASCENDING)],
+        [('item.$ref', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)],
+    ]
 
 
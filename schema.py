@@ -5,7 +5,7 @@ Distributed under the MIT license, see LICENSE file for details.
 '''
 
 from coconut.error import *
-from coconut.primitive import Element, Int, Str, Float
+from coconut.primitive import Element
 import coconut.container
 
 from pymongo import MongoClient
@@ -56,9 +56,6 @@ class Schema (object):
     }
     '''
 
-    def validate_schema (self, structure):
-        pass
-
     @classmethod
     def get_type (cls, schema):
         if schema == any: return any
@@ -66,6 +63,30 @@ class Schema (object):
             if t in schema: return t
         raise SchemaUnknownType (schema)
 
+    @classmethod
+    def compile (cls, schema):
+        '''Compile a schema and its nested schemas into a Plan.
+
+        Plans are not cached here: DocumentClass compiles each Document schema
+        once and keeps the plan on the class, and containers carry the plans
+        of their items, so only ad-hoc schemas are compiled per call. Errors in
+        the schema are deferred until the plan is first used, matching the
+        behaviour of interpreting the schema on demand.
+        '''
+
+        if schema == any: return ANY
+        try:
+            cls.validate_schema(schema)
+            expected = cls.get_type(schema)
+            if expected == any: plan = AnyPlan(schema)
+            elif expected == id: plan = LinkPlan(schema)
+            elif expected == list: plan = ListPlan(schema)
+            elif expected == dict: plan = DictPlan(schema)
+            else: plan = PrimitivePlan(schema, expected)
+        except SchemaError as e:
+            plan = InvalidPlan(schema, e)
+        return plan
+
     @classmethod
     def import_document (self, source, document):
         '''Generate a Document from its database representation.'''
@@ -74,67 +95,7 @@ class Schema (object):
     @classmethod
     def import_element (cls, source, schema, parent):
         '''Generate an Element from source data according to a schema.'''
-        # TODO: Non-nullable fields
-        Schema.validate_schema(schema)
-        if source == None: return source
-
-        element = None
-        expected = Schema.get_type(schema)
-        element_type = type(source)
-
-        # Convert unicode to strings before letting an 'any' schema set the expected type
-        if element_type == unicode:
-            element_type = str
-            source = source.encode('utf-8')
- 
-        if expected == any:
-            # If we're expecting anything, we're expecting what we get
-            value_schema = any
-            if issubclass(element_type, DBRef) or issubclass(element_type, ObjectId):
-                expected = id
-            else:
-                expected = element_type 
-        else:
-            value_schema = schema[expected]
-
-        if expected == id:
-            element = coconut.element.Link (source, schema=schema)
-            return element
-
-        if not issubclass(element_type, expected) and not (expected == float and issubclass(element_type,int)):
-            if expected == bool and issubclass(element_type,int):
-                source = source == 1
-            else:
-                raise ValidationTypeError(expected,element_type)
-
-        # TODO: Validate primitives
-        if issubclass(element_type,str): element = Str(source)
-        elif issubclass(element_type,int): element = Int(source)
-        elif issubclass(element_type,float): element = Float(source)
-        elif issubclass(element_type,bool): element = source
-
-        elif element_type == list:
-            # TODO: Implement 'any'
-            element = coconut.container.List(parent=parent,schema=schema)
-            for i, item in enumerate(source):
-                element.append(item)
-
-        elif element_type == dict:
-            element = coconut.container.Dict(parent=parent,schema=schema)
-            for key, item in source.items():
-                element[key] = item
-            # Check for missing keys with default values
-            if isinstance(schema,dict) and dict in schema and isinstance(schema[dict],dict):
-                for key, item_schema in schema[dict].items():
-                    if not key in element:
-                        if isinstance(item_schema,dict) and 'default' in item_schema:
-                            element[key] = copy.deepcopy(item_schema['default'])
-                        else:
-                            element[key] = None
-        else:
-            raise ValidationTypeError ('type compatible with schema %s' % schema, element_type)
-
-        return element
+        return Schema.compile(schema).import_element(source, parent)
 
     @classmethod
     def export (cls, document):
@@ -144,68 +105,12 @@ class Schema (object):
     @classmethod
     def export_element (cls, source, schema=None):
         '''Generate a database element from an Element object.'''
-        # TODO: Non-nullable fields
-        if source == None: return source
+        if source is None: return source
         if not schema:
             if not isinstance(source,coconut.container.MutableElement):
                 raise ValueError ('Source must be of MutableElement type if no schema specified.')
-            schema = source.__schema__
-        Schema.validate_schema(schema)
-        element = None
-        expected = Schema.get_type(schema)
-        element_type = type(source)
-        
-        if expected == any:
-            # If we're expecting anything, we're expecting what we get
-            expected = element_type
-            value_schema = any
-        elif expected == id:
-            # If we're expecting an id, we're really expecting a Link
-            expected = coconut.element.Link
-            value_schema = schema[id]
-        else:
-            value_schema = schema[expected]
-
-        if not issubclass(element_type,Element):
-            raise ValidationTypeError(Element,element_type)
-
-        if not issubclass(element_type, expected) and not (expected == float and issubclass(element_type,int)):
-            if expected == bool and issubclass(element_type,int):
-                source = source == 1
-            else:
-                raise ValidationTypeError(expected,element_type)
-
-        if isinstance(source,bool):
-            element = source
-        
-        elif filter(lambda t: isinstance(source,t),[str,int,float,bool]):
-            # Don't do anything for primitives
-            element = source
-        elif isinstance(source, coconut.element.Link):
-            element = source.format_db()
-        elif isinstance(source, list):
-            element = []
-            for i, item in enumerate(source):
-                item_schema = Schema.get_list_index_schema(i,schema)
-                new_item = Schema.export_element(item,item_schema)
-                element.append(new_item)
-
-        elif isinstance(source,dict):
-            element = {}
-            for key, item in source.items():
-                if value_schema == any:
-                    new_item = Schema.export_element(item,value_schema)
-                elif not key in value_schema:
-                    raise ValidationKeyError (key)
-                else:
-                    item_schema = value_schema[key]
-                    new_item = Schema.export_element(item,item_schema)
-                element[key] = new_item
-        
-        else:
-            raise ValidationTypeError ([id,str,int,float,bool,list,dict,any], element_type)
-
-        return element
+            return source.__plan__.export_element(source)
+        return Schema.compile(schema).export_element(source)
 
     @classmethod
     def get_list_index_schema (cls, idx, schema):
@@ -238,3 +143,465 @@ class Schema (object):
             if t in [list,dict] and key in ['traverse']: continue
             raise SchemaUnknownKey(key,schema)
         
+
+#
+# Compiled schemas
+#
+
+def check_type (expected, source, element_type):
+    '''Return source if it is acceptable for the expected type, else raise.
+
+    Ints are accepted where floats are expected, and coerced where bools are.
+    '''
+
+    if issubclass(element_type, expected): return source
+    if expected == float and issubclass(element_type, int): return source
+    if expected == bool and issubclass(element_type, int): return source == 1
+    raise ValidationTypeError(expected, element_type)
+
+scalar_types = {}
+def get_scalar_type (element_type):
+    '''Return the native type that values of element_type are stored as.
+
+    Containers hold scalars as plain str, int and float objects rather than
+    wrapping each one in an Element. Returns None for non-scalar types.
+    Results are memoised per type.
+    '''
+
+    try:
+        return scalar_types[element_type]
+    except KeyError:
+        pass
+    if issubclass(element_type,str): scalar = str
+    elif issubclass(element_type,int): scalar = int
+    elif issubclass(element_type,float): scalar = float
+    else: scalar = None
+    scalar_types[element_type] = scalar
+    return scalar
+
+def import_scalar (source, element_type):
+    '''Return source as a native scalar, or None if it is not a scalar.'''
+
+    scalar = get_scalar_type(element_type)
+    if scalar is None: return None
+    if element_type is scalar: return source
+    return scalar(source)
+
+def is_element_type (element_type):
+    '''Return True if values of element_type may be held in a container.
+
+    Native scalars are accepted as well as Element types.
+    '''
+
+    return issubclass(element_type,Element) or get_scalar_type(element_type) is not None
+
+def get_projection_tree (fields):
+    '''Convert a list of dotted field paths into a projection tree.
+
+    The tree maps each projected key to None if the whole value was loaded,
+    or to the projection tree of its loaded subkeys. Projections apply to
+    every item of a list.
+    '''
+
+    tree = {}
+    for path in fields:
+        node = tree
+        terms = path.split('.')
+        for term in terms[:-1]:
+            if term in node and node[term] is None: break
+            node = node.setdefault(term, {})
+        else:
+            node[terms[-1]] = None
+    return tree
+
+def resolve_path (plan, path):
+    '''Return the plans for the container holding a dotted path and its value.'''
+
+    parent = None
+    for term in path.split('.'):
+        parent = plan
+        plan = plan.item_plan(int(term) if isinstance(plan, ListPlan) else term)
+    return parent, plan
+
+class Plan (object):
+    '''A schema compiled into import and export routines.
+
+    Plans are built by Schema.compile. Container plans hold
+    the plans of their items, so importing or exporting a value walks a
+    precomputed tree rather than the schema dict.
+
+    Instance variables
+     schema -- The schema the plan was compiled from.
+     traverse -- False if values set on the container are stored as-is.
+     has_default -- True if the schema provides a default value.
+    '''
+
+    traverse = True
+
+    def __init__ (self, schema):
+        self.schema = schema
+        self.has_default = isinstance(schema,dict) and 'default' in schema
+        self.default = schema['default'] if self.has_default else None
+
+    def get_default (self):
+        '''Return a fresh copy of the schema's default value, or None.'''
+
+        if isinstance(self.default,(str,unicode,int,long,float,bool)):
+            return self.default
+        return copy.deepcopy(self.default)
+
+    def is_default (self, value):
+        '''Return True if an exported value is None or the schema's default.'''
+
+        return value is None or (self.has_default and value == self.default)
+
+    def prune (self, value):
+        '''Return an exported value without the items a sparse Document omits.'''
+
+        return value
+
+    def import_element (self, source, parent):
+        '''Generate an Element from source data.'''
+
+        raise NotImplementedError()
+
+    def load_element (self, source, parent, fields=None):
+        '''Generate an Element from trusted database data.
+
+        Unlike import_element, values are not validated and containers are
+        built directly in their flushed state. If fields is given the data is
+        a partial projection of the stored value: see get_projection_tree.
+        '''
+
+        return self.import_element(source, parent)
+
+    def export_element (self, source):
+        '''Generate a database element from an Element object.'''
+
+        raise NotImplementedError()
+
+    def item_plan (self, key):
+        '''Return the plan for an item of a container.'''
+
+        raise SchemaTypeError(self.schema, 'Schema does not describe a container.')
+
+    def import_item (self, key, value, parent):
+        '''Generate an Element for an item of a container.'''
+
+        return self.item_plan(key).import_element(value, parent)
+
+    def import_list (self, source, parent):
+        element = coconut.container.List(parent=parent, schema=self.schema, plan=self)
+        for item in source:
+            element.append(item)
+        return element
+
+    def import_dict (self, source, parent):
+        element = coconut.container.Dict(parent=parent, schema=self.schema, plan=self)
+        for key, item in source.items():
+            element[key] = item
+        return element
+
+    def load_list (self, source, parent, fields=None):
+        element = coconut.container.List(parent=parent, schema=self.schema, plan=self)
+        if parent.__lazy__: element.__lazy__ = True
+        element.__fields__ = fields
+        list.extend(element, [self.load_item(i, item, element) for i, item in enumerate(source)])
+        return element
+
+    def load_dict (self, source, parent, fields=None):
+        element = coconut.container.Dict(parent=parent, schema=self.schema, plan=self)
+        if parent.__lazy__: element.__lazy__ = True
+        element.__fields__ = fields
+        self.load_items(source, element)
+        return element
+
+    def load_item (self, key, value, parent):
+        return self.item_plan(key).load_element(value, parent, parent.get_item_fields(key))
+
+    def load_items (self, source, element):
+        '''Fill a flushed Dict with trusted database data.
+
+        If the Dict is lazy the items are stored unconverted and recorded in
+        its __raw__ set, to be converted when first accessed.
+        '''
+
+        if element.__lazy__:
+            dict.update(element, source)
+            element.__raw__ = set(source)
+            return
+        for key, item in source.items():
+            dict.__setitem__(element, key, self.load_item(key, item, element))
+
+class InvalidPlan (Plan):
+    '''Plan for a schema that failed validation.
+
+    The error is raised whenever the plan is used.
+    '''
+
+    def __init__ (self, schema, error):
+        Plan.__init__(self, schema)
+        self.error = error
+
+    def import_element (self, source, parent):
+        raise self.error
+
+    def export_element (self, source):
+        raise self.error
+
+    def item_plan (self, key):
+        raise self.error
+
+class AnyPlan (Plan):
+    '''Plan for the any schema, which takes its type from the value.'''
+
+    def import_element (self, source, parent):
+        if source is None: return source
+        element_type = type(source)
+        if element_type == unicode:
+            element_type = str
+            source = source.encode('utf-8')
+        if issubclass(element_type, DBRef) or issubclass(element_type, ObjectId):
+            return coconut.element.Link (source, schema=self.schema)
+        scalar = import_scalar(source, element_type)
+        if scalar is not None: return scalar
+        if element_type == list: return self.import_list(source, parent)
+        if element_type == dict: return self.import_dict(source, parent)
+        raise ValidationTypeError ('type compatible with schema %s' % self.schema, element_type)
+
+    def load_element (self, source, parent, fields=None):
+        if source is None: return source
+        element_type = type(source)
+        if element_type == unicode: return source.encode('utf-8')
+        scalar = import_scalar(source, element_type)
+        if scalar is not None: return scalar
+        if element_type == list: return self.load_list(source, parent, fields)
+        if element_type == dict: return self.load_dict(source, parent, fields)
+        return self.import_element(source, parent)
+
+    def export_element (self, source):
+        if source is None: return source
+        element_type = type(source)
+        if not is_element_type(element_type):
+            raise ValidationTypeError(Element,element_type)
+        if isinstance(source,(str,int,float,bool)):
+            return source
+        if isinstance(source, coconut.element.Link):
+            return source.format_db()
+        if isinstance(source, list):
+            return [ANY.export_element(item) for item in source]
+        if isinstance(source, dict):
+            return dict((key, ANY.export_element(item)) for key, item in source.items())
+        raise ValidationTypeError ([id,str,int,float,bool,list,dict,any], element_type)
+
+    def item_plan (self, key):
+        return ANY
+
+ANY = AnyPlan(any)
+
+class PrimitivePlan (Plan):
+    '''Plan for str, int, float and bool schemas.'''
+
+    def __init__ (self, schema, expected):
+        Plan.__init__(self, schema)
+        self.expected = expected
+
+    def import_element (self, source, parent):
+        if source is None: return source
+        element_type = type(source)
+        if element_type == unicode:
+            element_type = str
+            source = source.encode('utf-8')
+        source = check_type(self.expected, source, element_type)
+        scalar = import_scalar(source, element_type)
+        if scalar is None:
+            raise ValidationTypeError ('type compatible with schema %s' % self.schema, element_type)
+        return scalar
+
+    def load_element (self, source, parent, fields=None):
+        if source is None: return source
+        element_type = type(source)
+        if element_type == unicode: return source.encode('utf-8')
+        scalar = import_scalar(source, element_type)
+        if scalar is not None: return scalar
+        return self.import_element(source, parent)
+
+    def export_element (self, source):
+        if source is None: return source
+        element_type = type(source)
+        if not is_element_type(element_type):
+            raise ValidationTypeError(Element,element_type)
+        return check_type(self.expected, source, element_type)
+
+class LinkPlan (Plan):
+    '''Plan for id schemas, whose values are Links.'''
+
+    def import_element (self, source, parent):
+        if source is None: return source
+        if type(source) == unicode:
+            source = source.encode('utf-8')
+        return coconut.element.Link (source, schema=self.schema)
+
+    def export_element (self, source):
+        if source is None: return source
+        element_type = type(source)
+        if not issubclass(element_type,Element):
+            raise ValidationTypeError(Element,element_type)
+        check_type(coconut.element.Link, source, element_type)
+        return source.format_db()
+
+class ListPlan (Plan):
+    '''Plan for list schemas.
+
+    Instance variables
+     items -- Plans for each position in the list, or None if the schema
+              constraint is any.
+     range_all -- True if the first item plan applies to every position.
+    '''
+
+    def __init__ (self, schema):
+        Plan.__init__(self, schema)
+        self.traverse = schema.get('traverse',True)
+        self.range_all = schema.get(range,None) == all
+        item_schemas = schema[list]
+        if item_schemas == any or not isinstance(item_schemas,list):
+            self.items = None
+        else:
+            self.items = [Schema.compile(item) for item in item_schemas]
+
+    def import_element (self, source, parent):
+        if source is None: return source
+        element_type = type(source)
+        check_type(list, source, element_type)
+        if element_type != list:
+            raise ValidationTypeError ('type compatible with schema %s' % self.schema, element_type)
+        return self.import_list(source, parent)
+
+    def load_element (self, source, parent, fields=None):
+        if type(source) != list: return self.import_element(source, parent)
+        return self.load_list(source, parent, fields)
+
+    def export_element (self, source):
+        if source is None: return source
+        element_type = type(source)
+        if not issubclass(element_type,Element):
+            raise ValidationTypeError(Element,element_type)
+        check_type(list, source, element_type)
+        return [self.item_plan(i).export_element(item) for i, item in enumerate(source)]
+
+    def item_plan (self, idx):
+        items = self.items
+        if items is None:
+            if self.schema[list] != any: raise SchemaError()
+            if self.range_all: return ANY
+            raise ValidationListError()
+        if idx < len(items):
+            return items[idx]
+        if self.range_all:
+            return items[0]
+        raise ValidationListError()
+
+    def import_item (self, idx, value, parent):
+        item_plan = self.item_plan(idx)
+        if not self.traverse: return value
+        return item_plan.import_element(value, parent)
+
+    def load_item (self, idx, value, parent):
+        item_plan = self.item_plan(idx)
+        if not self.traverse: return value
+        return item_plan.load_element(value, parent, parent.get_item_fields(idx))
+
+    def prune (self, value):
+        if not isinstance(value, list) or not self.traverse: return value
+        return [self.item_plan(i).prune(item) for i, item in enumerate(value)]
+
+class DictPlan (Plan):
+    '''Plan for dict schemas.
+
+    Instance variables
+     keys -- Maps each key to its plan, or None if any key is allowed.
+     defaults -- (key, plan) pairs for keys to fill in when missing.
+    '''
+
+    def __init__ (self, schema):
+        Plan.__init__(self, schema)
+        self.traverse = schema.get('traverse',True)
+        constraint = schema[dict]
+        self.keys = None
+        self.defaults = []
+        if isinstance(constraint,dict):
+            self.defaults = [(key, Schema.compile(item_schema))
+                for key, item_schema in constraint.items() if key != any]
+            if not any in constraint:
+                self.keys = dict(self.defaults)
+
+    def import_element (self, source, parent):
+        if source is None: return source
+        element_type = type(source)
+        check_type(dict, source, element_type)
+        if element_type != dict:
+            raise ValidationTypeError ('type compatible with schema %s' % self.schema, element_type)
+        element = self.import_dict(source, parent)
+        for key, item_plan in self.defaults:
+            if not key in element:
+                element[key] = item_plan.get_default()
+        return element
+
+    def load_element (self, source, parent, fields=None):
+        if type(source) != dict: return self.import_element(source, parent)
+        return self.load_dict(source, parent, fields)
+
+    def load_items (self, source, element):
+        Plan.load_items(self, source, element)
+        fields = element.__fields__
+        for key, item_plan in self.defaults:
+            if fields is not None and not key in fields: continue
+            if not key in source:
+                value = self.load_item(key, item_plan.get_default(), element)
+                dict.__setitem__(element, key, value)
+                if element.__defaulted__ is None: element.__defaulted__ = set()
+                element.__defaulted__.add(key)
+
+    def prune (self, value):
+        if not isinstance(value, dict) or not self.defaults: return value
+        plans = dict(self.defaults)
+        element = {}
+        for key, item in value.items():
+            item_plan = plans.get(key)
+            if item_plan is None:
+                element[key] = item
+            elif not item_plan.is_default(item):
+                element[key] = item_plan.prune(item)
+        return element
+
+    def export_element (self, source):
+        if source is None: return source
+        element_type = type(source)
+        if not issubclass(element_type,Element):
+            raise ValidationTypeError(Element,element_type)
+        check_type(dict, source, element_type)
+        element = {}
+        for key, item in source.items():
+            element[key] = self.item_plan(key).export_element(item)
+        return element
+
+    def item_plan (self, key):
+        if self.keys is None: return ANY
+        try:
+            return self.keys[key]
+        except KeyError:
+            raise ValidationKeyError (key)
+
+    def import_item (self, key, value, parent):
+        if self.keys is None:
+            return ANY.import_element(value, parent)
+        item_plan = self.item_plan(key)
+        if not self.traverse: return value
+        return item_plan.import_element(value, parent)
+
+    def load_item (self, key, value, parent):
+        if self.keys is None:
+            return ANY.load_element(value, parent, parent.get_item_fields(key))
+        item_plan = self.item_plan(key)
+        if not self.traverse: return value
+        return item_plan.load_element(value, parent, parent.get_item_fields(key))
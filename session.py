@@ -0,0 +1,63 @@
+''' session.py -- Identity map for Coconut documents
+Author: Luke Williams <shmookey@shmookey.net>
+
+Distributed under the MIT license, see LICENSE file for details.
+'''
+
+import threading
+
+local = threading.local()
+
+def get_session ():
+    '''Return the Session active in the current thread, or None.'''
+
+    return getattr(local, 'session', None)
+
+class Session (object):
+    '''An identity map of the Documents loaded while it is active.
+
+    While a Session is active, looking up a Document by ID, finding it by
+    query or dereferencing a Link to it returns the instance already loaded
+    in the session rather than a fresh copy. Sessions are opt-in and are
+    activated for the current thread by using them as a context manager:
+
+        with Session():
+            a = Person[id]
+            b = Person[id]   # Same instance as a, no database query
+
+    Instance variables
+     documents -- Maps (collection name, document ID) to Document instances.
+    '''
+
+    def __init__ (self):
+        self.documents = {}
+        self.previous = None
+
+    def __enter__ (self):
+        self.previous = get_session()
+        local.session = self
+        return self
+
+    def __exit__ (self, exc_type, exc_value, traceback):
+        local.session = self.previous
+        self.previous = None
+
+    def get (self, cls, id):
+        '''Return the loaded instance of a Document, or None.'''
+
+        return self.documents.get((cls.__name__, id))
+
+    def add (self, document):
+        '''Register a saved Document with the session.'''
+
+        self.documents[(type(document).__name__, document.id)] = document
+
+    def discard (self, document):
+        '''Remove a Document from the session, if present.'''
+
+        self.documents.pop((type(document).__name__, document.id), None)
+
+    def clear (self):
+        '''Forget all loaded Documents.'''
+
+        self.documents.clear()
@@ -0,0 +1,84 @@
+#!/usr/bin/python2.7
+
+import time, unittest
+
+from pymongo import MongoClient
+from bson.objectid import ObjectId
+
+import coconut.container
+from coconut.cache import DocumentCache
+from coconut.error import DocumentNotFound
+
+class TestDocumentCache (coconut.container.Document):
+    __schema__ = { 'name': { str: any } }
+
+class TestDBCache (unittest.TestCase):
+    '''Test the read-through DocumentCache.'''
+
+    def setUp (self):
+        self.db = coconut.container.Document.__db__ = MongoClient().coconut_test
+        TestDocumentCache.__cache__ = DocumentCache(size=2)
+
+    def tearDown(self):
+        TestDocumentCache.__cache__ = None
+        self.db.TestDocumentCache.remove()
+
+    def gen_doc (self, name='foo'):
+        doc = TestDocumentCache({'name':name})
+        doc.save()
+        return doc
+
+    def test_lookup_is_cached (self):
+        '''A second lookup by ID is served from the cache.'''
+
+        doc = self.gen_doc()
+        TestDocumentCache[doc.id]
+        self.db.TestDocumentCache.update({'_id':ObjectId(doc.id)},{'$set':{'name':'changed'}})
+        self.assertEquals (TestDocumentCache[doc.id].name, 'foo')
+
+    def test_cached_copies_are_independent (self):
+        '''Modifying a Document returned from the cache does not modify the cache.'''
+
+        doc = self.gen_doc()
+        TestDocumentCache[doc.id].name = 'changed'
+        self.assertEquals (TestDocumentCache[doc.id].name, 'foo')
+
+    def test_save_invalidates (self):
+        '''Saving a Document invalidates its cached copy and cached queries.'''
+
+        doc = self.gen_doc()
+        self.assertEquals (TestDocumentCache.find_first({'name':'foo'}).id, doc.id)
+        doc.name = 'bar'
+        doc.save()
+        self.assertEquals (TestDocumentCache[doc.id].name, 'bar')
+        self.assertRaises (DocumentNotFound, TestDocumentCache.find_first, {'name':'foo'})
+
+    def test_remove_invalidates (self):
+        '''Removing a Document invalidates its cached copy.'''
+
+        doc = self.gen_doc()
+        docid = doc.id
+        TestDocumentCache[docid]
+        doc.remove()
+        self.assertRaises (DocumentNotFound, lambda: TestDocumentCache[docid])
+
+    def test_lru_eviction (self):
+        '''The least recently used entry is evicted when the cache is full.'''
+
+        cache = TestDocumentCache.__cache__
+        docs = [self.gen_doc(name) for name in ['a','b','c']]
+        for doc in docs: TestDocumentCache[doc.id]
+        self.assertIsNone (cache.get('TestDocumentCache', docs[0].id))
+        self.assertIsNotNone (cache.get('TestDocumentCache', docs[2].id))
+
+    def test_ttl_expiry (self):
+        '''Entries older than the TTL are not returned.'''
+
+        cache = TestDocumentCache.__cache__ = DocumentCache(ttl=0.01)
+        doc = self.gen_doc()
+        TestDocumentCache[doc.id]
+        time.sleep(0.02)
+        self.assertIsNone (cache.get('TestDocumentCache', doc.id))
+
+if __name__ == '__main__':
+    unittest.main()
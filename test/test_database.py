@@ -1,8 +1,9 @@
 #!/usr/bin/python2.7
 
-import unittest
+import gc, unittest, weakref
 
 from pymongo import MongoClient
+from bson.objectid import ObjectId
 
 import coconut.container
 import coconut.element
@@ -122,6 +123,222 @@ class TestSchema (unittest.TestCase):
         self.assertEqual (instance.attr_float, self.source_data['attr_float'])
         self.assertEqual (instance.attr_dict['subattr_str'], self.source_data['attr_dict']['subattr_str'])
 
+    def test_load_fills_missing_defaults (self):
+        '''Keys missing from a stored document are defaulted on load without being marked changed.'''
+        instance = TestDocument (self.source_data)
+        instance.save()
+        self.db.TestDocument.update({'_id':ObjectId(instance.id)},{'$unset':{'attr_str_default':''}})
+        loaded = TestDocument[instance.id]
+        self.assertEqual (loaded.attr_str_default, 'value')
+        self.assertEqual (loaded.attr_list_default, [])
+        sets, unsets = loaded.get_changes()
+        self.assertEqual (sets, {})
+        self.assertEqual (unsets, {})
+
+    def test_lazy_load (self):
+        '''A lazy Document converts items on first access and leaves unvisited items unchanged.'''
+
+        class LazyTestDocument (coconut.container.Document):
+            __schema__ = TestDocument.__schema__
+            __lazy__ = True
+
+        instance = LazyTestDocument (self.source_data)
+        instance.save()
+        loaded = LazyTestDocument[instance.id]
+        self.assertNotIsInstance (dict.__getitem__(loaded,'attr_dict'), coconut.container.Dict)
+        self.assertEqual (loaded.attr_dict['subattr_str'], self.source_data['attr_dict']['subattr_str'])
+        self.assertIsInstance (dict.__getitem__(loaded,'attr_dict'), coconut.container.Dict)
+        loaded.attr_int = 43
+        sets, unsets = loaded.get_changes()
+        self.assertEqual (sets, {'attr_int': 43})
+        self.assertEqual (loaded.export()['attr_str'], self.source_data['attr_str'])
+
+    def test_find_iter (self):
+        '''find_iter yields loaded documents honouring sort, skip and limit.'''
+
+        class IterTestDocument (coconut.container.Document):
+            __schema__ = { 'n': { int: any } }
+
+        self.db.IterTestDocument.remove()
+        for n in range(5):
+            IterTestDocument({'n':n}).save()
+        results = IterTestDocument.find_iter(sort=('n',-1), skip=1, limit=3, batch_size=2)
+        self.assertEqual ([doc.n for doc in results], [3,2,1])
+
+    def test_partial_load (self):
+        '''Fields left out of a projection are not defaulted or written back.'''
+        instance = TestDocument (self.source_data)
+        instance.save()
+        loaded = TestDocument.find_by_id(instance.id, fields=['attr_int','attr_dict.subattr_str'])
+        self.assertEqual (loaded.attr_int, self.source_data['attr_int'])
+        self.assertEqual (loaded.attr_dict['subattr_str'], self.source_data['attr_dict']['subattr_str'])
+        self.assertFalse (loaded.is_loaded('attr_str_default'))
+        self.assertNotIn ('attr_str_default', loaded)
+        loaded.attr_int = 7
+        loaded.save()
+        reloaded = TestDocument[instance.id]
+        self.assertEqual (reloaded.attr_int, 7)
+        self.assertEqual (reloaded.attr_str, self.source_data['attr_str'])
+
+    def test_get_many (self):
+        '''get_many returns documents in the order requested and reports missing IDs.'''
+
+        first = TestDocument (self.source_data)
+        first.save()
+        second = TestDocument (self.source_data)
+        second.save()
+        missing_id = str(ObjectId())
+        ids = [second.id, missing_id, ObjectId(first.id), second.id]
+        documents, missing = TestDocument.get_many(ids, chunk_size=1)
+        self.assertEqual ([doc.id for doc in documents], [second.id, first.id, second.id])
+        self.assertEqual (missing, [missing_id])
+
+    def test_dirty_tracking (self):
+        '''Writing a nested key flags its ancestors as changed until they are flushed.'''
+        instance = TestDocument (self.source_data)
+        instance.save()
+        loaded = TestDocument[instance.id]
+        self.assertFalse (loaded.__changed__)
+        loaded.attr_dict['subattr_str'] = 'Changed'
+        self.assertTrue (loaded.attr_dict.__changed__)
+        self.assertTrue (loaded.__changed__)
+        sets, unsets = loaded.get_changes()
+        self.assertEqual (sets, {'attr_dict.subattr_str': 'Changed'})
+        loaded.save()
+        self.assertFalse (loaded.__changed__)
+        self.assertFalse (loaded.attr_dict.__changed__)
+        self.assertEqual (loaded.get_changes(), ({}, {}))
+
+    def test_overlay (self):
+        '''Unsaved changes are held in an overlay of the changed keys and merged on flush.'''
+        instance = TestDocument (self.source_data)
+        instance.attr_dict = dict(('key%i' % i, i) for i in range(100))
+        instance.save()
+        loaded = TestDocument[instance.id]
+        loaded.attr_dict['key1'] = 'changed'
+        loaded.attr_dict['new'] = 'added'
+        del loaded.attr_dict['key2']
+        self.assertEqual (loaded.attr_dict.__unsaved__, {'key1': 'changed', 'new': 'added'})
+        self.assertEqual (loaded.attr_dict.__removed__, set(['key2']))
+        self.assertEqual (len(loaded.attr_dict), 100)
+        self.assertEqual (loaded.attr_dict['key1'], 'changed')
+        self.assertNotIn ('key2', loaded.attr_dict)
+        sets, unsets = loaded.get_changes()
+        self.assertEqual (sets, {'attr_dict.key1': 'changed', 'attr_dict.new': 'added'})
+        self.assertEqual (unsets, {'attr_dict.key2': ''})
+        loaded.save()
+        self.assertIsNone (loaded.attr_dict.__unsaved__)
+        loaded = TestDocument[instance.id]
+        self.assertEqual (loaded.attr_dict['new'], 'added')
+        self.assertNotIn ('key2', loaded.attr_dict)
+
+    def test_no_reference_cycles (self):
+        '''Containers refer to their Document weakly, so it is freed without the cyclic garbage collector.'''
+        gc.disable()
+        try:
+            instance = TestDocument (self.source_data)
+            instance.attr_rangelist = ['a']
+            nested = instance.attr_dict
+            self.assertIs (nested.get_document(), instance)
+            self.assertIs (instance.attr_rangelist.get_document(), instance)
+            document = weakref.ref(instance)
+            del instance
+            self.assertIsNone (document())
+            self.assertIsNone (nested.get_document())
+        finally:
+            gc.enable()
+
+    def test_sparse_storage (self):
+        '''A sparse Document does not store None or default values but has them when loaded.'''
+
+        class SparseTestDocument (coconut.container.Document):
+            __schema__ = {
+                'name':  { str: any },
+                'count': { int: any },
+                'state': { str: any, 'default': 'new' },
+                'tags':  { list: [ { str: any } ], range: all, 'default': [] },
+            }
+            __sparse__ = True
+
+        instance = SparseTestDocument ({'name':'Sparse'})
+        instance.save()
+        stored = self.db.SparseTestDocument.find_one({'_id':ObjectId(instance.id)})
+        self.assertEqual (set(stored), set(['_id','__active__','name']))
+        loaded = SparseTestDocument[instance.id]
+        self.assertEqual (loaded.state, 'new')
+        self.assertIsNone (loaded.count)
+        loaded.state = 'old'
+        loaded.tags.append('tag')
+        loaded.save()
+        loaded = SparseTestDocument[instance.id]
+        self.assertEqual (loaded.state, 'old')
+        self.assertEqual (loaded.tags, ['tag'])
+        loaded.state = 'new'
+        loaded.name = None
+        loaded.save()
+        stored = self.db.SparseTestDocument.find_one({'_id':ObjectId(instance.id)})
+        self.assertEqual (set(stored), set(['_id','__active__','tags']))
+        self.db.SparseTestDocument.remove()
+
+    def test_sparse_array_operators (self):
+        '''Sparse lists updated with array operators are unset at their default and pruned.'''
+
+        class SparseTestDocument (coconut.container.Document):
+            __schema__ = {
+                'tags':    { list: [ { str: any } ], range: all, 'default': [] },
+                'entries': { list: [ { dict: {
+                    'name':  { str: any },
+                    'state': { str: any, 'default': 'new' },
+                } } ], range: all, 'default': [] },
+            }
+            __sparse__ = True
+
+        instance = SparseTestDocument ()
+        instance.save()
+        instance.tags.append('a')
+        instance.save()
+        self.assertEqual (self.db.SparseTestDocument.find_one()['tags'], ['a'])
+        instance.tags.pop()
+        ops = {}
+        sets, unsets = instance.get_changes(ops)
+        self.assertEqual ((sets, unsets, ops), ({}, {'tags': ''}, {}))
+        instance.save()
+        self.assertNotIn ('tags', self.db.SparseTestDocument.find_one())
+
+        instance.entries.append({'name':'x'})
+        ops = {}
+        sets, unsets = instance.get_changes(ops)
+        self.assertEqual ((sets, ops), ({'entries': [{'name':'x'}]}, {}))
+        instance.save()
+        self.assertEqual (self.db.SparseTestDocument.find_one()['entries'], [{'name':'x'}])
+        self.assertEqual (SparseTestDocument[instance.id].entries[0]['state'], 'new')
+        self.db.SparseTestDocument.remove()
+
+    def test_dotted_changes (self):
+        '''Changes to list items are written by positional path.'''
+
+        class TestDocumentDotted (coconut.container.Document):
+            __schema__ = {
+                'names': { list: [ { str: any } ], range: all },
+                'entries': { list: [ { dict: { 'b': { str: any } } } ], range: all },
+            }
+
+        instance = TestDocumentDotted({'names':['a'], 'entries':[{'b':'c'}]})
+        instance.save()
+        loaded = TestDocumentDotted[instance.id]
+        loaded.names[0] = 'd'
+        loaded.entries[0]['b'] = 'e'
+        sets, unsets = loaded.get_changes()
+        self.assertEqual (sets, {'names.0': 'd', 'entries.0.b': 'e'})
+        loaded.save()
+        loaded = TestDocumentDotted[instance.id]
+        self.assertEqual (loaded.names, ['d'])
+        self.assertEqual (loaded.entries[0]['b'], 'e')
+        loaded.names.append('f')
+        sets, unsets = loaded.get_changes()
+        self.assertEqual (sets, {'names': ['d', 'f']})
+        self.db.TestDocumentDotted.remove()
+
     def test_links (self):
         dynamic_link_instance = AnotherTestDocument({'name':'Dynamic Link Target'})
         dynamic_link_instance.save()
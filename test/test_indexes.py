@@ -2,6 +2,7 @@
 
 import unittest
 
+import pymongo
 from pymongo import MongoClient
 
 import coconut.container
@@ -49,6 +50,20 @@ class TestDBIndexes (unittest.TestCase):
             self.assertEquals(idx[:4],'attr')
             self.assertEquals(info['key'][0][0],'attr')
 
+    def test_ensure_compound_indexes (self):
+        '''ensure_indexes creates the compound indexes listed in __indexes__ and those of Revision.'''
+
+        class TestDocumentIndex (coconut.container.Document):
+            __schema__ = { 'attr': { str: any }, 'other': { int: any } }
+            __indexes__ = [ [('attr', pymongo.ASCENDING), ('other', pymongo.DESCENDING)] ]
+
+        TestDocumentIndex.ensure_indexes()
+        keys = [info['key'] for info in self.db.TestDocumentIndex.index_information().values()]
+        self.assertIn([('attr', pymongo.ASCENDING), ('other', pymongo.DESCENDING)], keys)
+        keys = [info['key'] for info in self.db.Revision.index_information().values()]
+        self.assertIn([('item.$id', pymongo.ASCENDING), ('date', pymongo.ASCENDING)], keys)
+        self.assertIn([('item.$id', pymongo.ASCENDING), ('fields', pymongo.ASCENDING), ('date', pymongo.ASCENDING)], keys)
+
     def test_unique_index_enforced (self):
         '''Violating a unique index raises an UniqueIndexViolation upon saving.'''
 
@@ -65,6 +80,24 @@ class TestDBIndexes (unittest.TestCase):
 
         self.assertRaises(UniqueIndexViolation,f)
 
+    def test_unique_index_enforced_on_save_all (self):
+        '''save_all saves valid documents and reports those violating a unique index.'''
+
+        class TestDocumentIndex (coconut.container.Document):
+            __schema__ = { 'attr': { str: any, 'index':'unique' } }
+
+        TestDocumentIndex.ensure_indexes()
+        docs = [TestDocumentIndex({'attr':attr}) for attr in ['foo','bar','foo']]
+        try:
+            TestDocumentIndex.save_all(docs)
+        except UniqueIndexViolation as e:
+            self.assertEquals(e.documents, [docs[2]])
+        else:
+            self.fail('UniqueIndexViolation not raised')
+        self.assertIsNotNone(docs[0].id)
+        self.assertIsNotNone(docs[1].id)
+        self.assertIsNone(docs[2].id)
+
 if __name__ == '__main__':
     unittest.main()
 
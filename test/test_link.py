@@ -15,6 +15,7 @@ class TestDBLinks (unittest.TestCase):
 
     def tearDown(self):
         self.db.TestDocumentLink.remove()
+        self.db.TestDocumentLinkTarget.remove()
 
     def test_export_link_becomes_objectid (self):
         '''A schema may include the mapping index:True.'''
@@ -24,6 +25,33 @@ class TestDBLinks (unittest.TestCase):
 
         doc1 = TestDocumentIndex({'attr':'foo'})
 
+    def test_prefetch (self):
+        '''Prefetching fills in the targets of Links at the given paths, including inside lists.'''
+
+        class TestDocumentLinkTarget (coconut.container.Document):
+            __schema__ = { 'name': { str: any } }
+
+        class TestDocumentLink (coconut.container.Document):
+            __schema__ = {
+                'referer': { id: 'TestDocumentLinkTarget' },
+                'friends': { list: [ { id: any } ], range: all, 'default': [] },
+            }
+
+        targets = [TestDocumentLinkTarget({'name':name}) for name in ['a','b','c']]
+        for target in targets: target.save()
+        for i in range(3):
+            doc = TestDocumentLink({'referer':targets[i]})
+            doc.friends.append(targets[(i+1)%3])
+            doc.save()
+
+        docs = TestDocumentLink.find(prefetch=['referer','friends'])
+        self.assertEquals (len(docs), 3)
+        for doc in docs:
+            self.assertIsNotNone (doc.referer.document)
+            self.assertIsNotNone (doc.friends[0].document)
+            self.assertEquals (doc.referer().id, doc.referer.targetid)
+            self.assertEquals (doc.friends[0]().id, str(doc.friends[0].targetid))
+
 if __name__ == '__main__':
     unittest.main()
 
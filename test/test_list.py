@@ -284,6 +284,132 @@ class TestDBLists (unittest.TestCase):
         instance2.save()
         self.assertEquals(instance2.foo[0], 'hello')
         self.assertEquals(instance2.bar[0], 'hi')
-        
+
+    def test_list_array_operators (self):
+        '''Appends, inserts, pops and removals are saved with array update operators.'''
+
+        class TestDocument_List (coconut.container.Document):
+            __schema__ = { 'foo': {
+              list: [ { str: any } ],
+              range: all,
+              'default': [] }
+            }
+
+        instance = TestDocument_List ({'foo':['a','b','c']})
+        instance.save()
+
+        def check (expected_ops, expected):
+            ops = {}
+            sets, unsets = instance.get_changes(ops)
+            self.assertEquals(sets, {})
+            self.assertEquals(ops, expected_ops)
+            instance.save()
+            self.assertEquals(list(TestDocument_List[instance.id].foo), expected)
+
+        instance.foo.extend(['d','e'])
+        check({'$push': {'foo': {'$each': ['d','e']}}}, ['a','b','c','d','e'])
+        instance.foo.insert(1, 'x')
+        check({'$push': {'foo': {'$each': ['x'], '$position': 1}}}, ['a','x','b','c','d','e'])
+        instance.foo.pop()
+        check({'$pop': {'foo': 1}}, ['a','x','b','c','d'])
+        instance.foo.pop(0)
+        instance.foo.pop(0)
+        check({'$push': {'foo': {'$each': [], '$slice': -3}}}, ['b','c','d'])
+        instance.foo.remove('c')
+        check({'$pull': {'foo': 'c'}}, ['b','d'])
+
+    def test_list_overlay (self):
+        '''Item writes and appends are held in an overlay until flushed.'''
+
+        class TestDocument_List (coconut.container.Document):
+            __schema__ = { 'foo': {
+              list: [ { str: any } ],
+              range: all,
+              'default': [] }
+            }
+
+        instance = TestDocument_List ({'foo':['a','b','c']})
+        instance.save()
+        instance.foo[1] = 'x'
+        instance.foo.append('d')
+        self.assertEquals(instance.foo.__unsaved__, {1: 'x'})
+        self.assertEquals(instance.foo.__appended__, ['d'])
+        self.assertEquals(list(instance.foo), ['a','x','c','d'])
+        self.assertEquals(instance.foo[-1], 'd')
+        self.assertEquals(len(instance.foo), 4)
+        instance.save()
+        self.assertIsNone(instance.foo.__unsaved__)
+        self.assertEquals(list(TestDocument_List[instance.id].foo), ['a','x','c','d'])
+
+    def test_list_reorder_sets_whole_list (self):
+        '''Changes that cannot be expressed with one array operator rewrite the list.'''
+
+        class TestDocument_List (coconut.container.Document):
+            __schema__ = { 'foo': {
+              list: [ { str: any } ],
+              range: all,
+              'default': [] }
+            }
+
+        instance = TestDocument_List ({'foo':['a','b','c']})
+        instance.save()
+        instance.foo.remove('a')
+        instance.foo.append('a')
+        ops = {}
+        sets, unsets = instance.get_changes(ops)
+        self.assertEquals(ops, {})
+        self.assertEquals(sets, {'foo': ['b','c','a']})
+        instance.save()
+        self.assertEquals(list(TestDocument_List[instance.id].foo), ['b','c','a'])
+
+    def test_failed_mutators_leave_list_saveable (self):
+        '''A failed insert, pop or remove leaves the list unchanged and saveable.'''
+
+        class TestDocument_List (coconut.container.Document):
+            __schema__ = { 'foo': {
+              list: [ { str: any } ],
+              range: all,
+              'default': [] }
+            }
+
+        def failing_insert (instance):
+            self.assertRaises(ValidationTypeError, instance.foo.insert, 0, 123)
+
+        def failing_pop (instance):
+            self.assertRaises(IndexError, instance.foo.pop, 5)
+
+        def failing_remove (instance):
+            self.assertRaises(ValueError, instance.foo.remove, 'x')
+
+        for fail in (failing_insert, failing_pop, failing_remove):
+            instance = TestDocument_List ({'foo':['a','b']})
+            instance.save()
+            fail(instance)
+            self.assertIsNone(instance.foo.__ops__)
+            instance.foo[1] = 'c'
+            instance.save()
+            self.assertEquals(list(TestDocument_List[instance.id].foo), ['a','c'])
+
+    def test_working_copy_set_whole (self):
+        '''Item writes to a list rebuilt as a working copy set the whole list.'''
+
+        class TestDocument_List (coconut.container.Document):
+            __schema__ = { 'foo': {
+              list: [ { str: any } ],
+              range: all,
+              'default': [] }
+            }
+
+        instance = TestDocument_List ({'foo':['a','b']})
+        instance.save()
+        instance.foo.rebuild()
+        instance.foo[0] = 'c'
+        ops = {}
+        sets, unsets = instance.get_changes(ops)
+        self.assertEquals(sets, {'foo': ['c','b']})
+        self.assertEquals(ops, {})
+        instance.save()
+        self.assertEquals(list(TestDocument_List[instance.id].foo), ['c','b'])
+
 if __name__ == '__main__':
     unittest.main()
@@ -5,6 +5,7 @@ import unittest
 from pymongo import MongoClient
 
 import coconut.container
+import coconut.primitive
 from coconut.error import ValidationTypeError, ValidationKeyError
 
 class TestDBPrimitives (unittest.TestCase):
@@ -36,5 +37,20 @@ class TestDBPrimitives (unittest.TestCase):
         doc.attr += 1
         self.assertEquals(doc.attr,1)
 
+    def test_native_scalars (self):
+        '''Scalars are held as native values and still export.'''
+
+        class TestDocument (coconut.container.Document):
+            __schema__ = { 'attr': { str: any }, 'count': { int: any }, 'other': any }
+
+        doc = TestDocument({'attr':u'foo','count':3,'other':2.5})
+        self.assertIs(type(doc.attr), str)
+        self.assertIs(type(doc.count), int)
+        self.assertIs(type(doc.other), float)
+        self.assertEquals(doc.export()['attr'], 'foo')
+        doc.count = coconut.primitive.Int(4)
+        self.assertIs(type(doc.count), int)
+        self.assertFalse(hasattr(coconut.primitive.Str('foo'), '__dict__'))
+
 if __name__ == '__main__':
     unittest.main()
@@ -6,6 +6,7 @@ from pymongo import MongoClient
 from bson.objectid import ObjectId
 
 import coconut.container
+import coconut.error
 import coconut.revision
 
 class TestDBRevision (unittest.TestCase):
@@ -33,6 +34,22 @@ class TestDBRevision (unittest.TestCase):
         self.assertIn ('attr', r.changes['set'])
         self.assertEquals (r.changes['set']['attr'], 'foo')
 
+    def test_save_all_creates_revisions (self):
+        '''Saving Documents with save_all creates a Revision for each changed one.'''
+
+        class TestDocumentRevision (coconut.container.Document):
+            __schema__ = { 'attr': { str: any } }
+
+        docs = [TestDocumentRevision({'attr':'foo'}) for i in range(3)]
+        TestDocumentRevision.save_all(docs)
+        docs[0].attr = 'bar'
+        TestDocumentRevision.save_all(docs)
+
+        self.assertEquals (TestDocumentRevision[docs[0].id].attr, 'bar')
+        self.assertEquals (len(coconut.revision.Revision.find({'item.$id':docs[0].id})), 2)
+        self.assertEquals (len(coconut.revision.Revision.find({'item.$id':docs[1].id})), 1)
+        self.assertEquals (docs[0].history('attr').next(), 'bar')
+
     def test_history_first_revision (self):
         '''history.first() selects the original Revision.'''
 
@@ -147,6 +164,23 @@ class TestDBRevision (unittest.TestCase):
         self.assertIn('foo', revision)
         self.assertNotIn('bar',revision)
 
+    def test_skip_unchanged_save (self):
+        '''Saving a Document without changes writes nothing and creates no Revision.'''
+
+        class TestDocumentRevision (coconut.container.Document):
+            __schema__ = { 'foo': { int: any } }
+
+        doc = TestDocumentRevision({'foo':1})
+        self.assertTrue(doc.save())
+        self.assertFalse(doc.save())
+        doc.foo = 1
+        self.assertFalse(doc.save())
+        self.assertEquals(TestDocumentRevision.save_all([doc]), [])
+        revisions = coconut.revision.Revision.find({'item.$id':doc.id})
+        self.assertEquals(len(revisions), 1)
+        doc.foo = 2
+        self.assertTrue(doc.save())
+
     def test_skip_redundant_keys_on_update (self):
         '''Calling update() with unchanged fields does not mark those fields changed.'''
 
@@ -185,6 +219,362 @@ class TestDBRevision (unittest.TestCase):
             self.assertEquals(val,4-j)
         self.assertEquals(j,4)
 
+    def test_history_order_slice_and_bounds (self):
+        '''History can be reversed, sliced and bounded by revision date.'''
+
+        class TestDocumentRevision (coconut.container.Document):
+            __schema__ = { 'foo': { int: any } }
+
+        doc = TestDocumentRevision()
+        for i in range(10):
+            doc.foo = i
+            doc.save()
+        dates = [r['date'] for r in self.db.Revision.find({'item.$id':doc.id}).sort('date')]
+
+        self.assertEquals(list(doc.history('foo', batch_size=3)), range(9,-1,-1))
+        self.assertEquals(list(reversed(doc.history('foo'))), range(10))
+        self.assertEquals(list(doc.history('foo')[2:5]), [7,6,5])
+        self.assertEquals(list(doc.history('foo', ascending=True)[8:]), [8,9])
+        self.assertEquals(list(doc.history('foo')[2:5][1:]), [6,5])
+        self.assertEquals(list(doc.history('foo')[3:3]), [])
+        self.assertEquals(list(reversed(doc.history('foo')[0:3])), [7,8,9])
+        self.assertEquals(list(reversed(doc.history('foo')[8:])), [0,1])
+        self.assertEquals(list(reversed(doc.history('foo', ascending=True)[2:5])), [4,3,2])
+        self.assertEquals(list(reversed(doc.history('foo')[12:15])), [])
+        self.assertEquals(doc.history('foo')[1], 8)
+        self.assertRaises(IndexError, lambda: doc.history('foo')[10])
+        bounded = doc.history('foo', start=dates[3], end=dates[6])
+        self.assertEquals(list(bounded), [5,4,3])
+
+    def test_document_at (self):
+        '''Document.at rebuilds the state of a Document at a given time.'''
+
+        class TestDocumentRevision (coconut.container.Document):
+            __schema__ = {
+                'foo': { int: any },
+                'thang': { dict: any },
+                'tags': { list: [ { str: any } ], range: all, 'default': [] },
+            }
+
+        doc = TestDocumentRevision({'foo':0,'thang':{'thing':1,'thong':2}})
+        doc.save()
+        times = [time.time()]
+        doc.foo = 1
+        doc.tags.extend(['a','b','c'])
+        doc.save()
+        times.append(time.time())
+        doc.thang = {'thing':3}
+        doc.tags.remove('b')
+        doc.save()
+        times.append(time.time())
+        doc.thang['thong'] = 4
+        doc.tags.pop(0)
+        doc.save()
+
+        states = [
+            (0, {'thing':1,'thong':2}, []),
+            (1, {'thing':1,'thong':2}, ['a','b','c']),
+            (1, {'thing':3}, ['a','c']),
+        ]
+        for timestamp, (foo, thang, tags) in zip(times, states):
+            old = doc.at(timestamp)
+            self.assertEquals(old.id, doc.id)
+            self.assertEquals(old.foo, foo)
+            self.assertEquals(dict(old.thang), thang)
+            self.assertEquals(list(old.tags), tags)
+        now = TestDocumentRevision.get_as_of(doc.id, time.time())
+        self.assertEquals(dict(now.thang), {'thing':3,'thong':4})
+        self.assertEquals(list(now.tags), ['c'])
+        self.assertRaises(coconut.error.DocumentNotFound, doc.at, times[0] - 60)
+
+    def test_snapshot_interval (self):
+        '''Every Nth Revision holds a snapshot, from which get_as_of replays.'''
+
+        class TestDocumentRevision (coconut.container.Document):
+            __schema__ = { 'foo': { int: any } }
+            __snapshot_interval__ = 3
+
+        doc = TestDocumentRevision({'foo':0})
+        doc.save()
+        times = []
+        for i in range(1, 7):
+            doc.foo = i
+            doc.save()
+            times.append(time.time())
+        revisions = list(self.db.Revision.find({'item.$id':doc.id}).sort('date'))
+        snapshots = [i for i, r in enumerate(revisions) if 'snapshot' in r['changes']]
+        self.assertEquals(snapshots, [2, 5])
+        self.assertEquals(revisions[5]['changes']['snapshot']['foo'], 5)
+        for i, timestamp in enumerate(times):
+            self.assertEquals(doc.at(timestamp).foo, i+1)
+        # A freshly loaded instance picks up the count from the database
+        loaded = TestDocumentRevision[doc.id]
+        loaded.foo = 7
+        loaded.save()
+        loaded.foo = 8
+        loaded.save()
+        self.assertIn('snapshot', self.db.Revision.find({'item.$id':doc.id}).sort('date',-1)[0]['changes'])
+
+    def test_compaction (self):
+        '''Old Revisions are squashed into checkpoints by the class retention policy.'''
+
+        class TestDocumentRevision (coconut.container.Document):
+            __schema__ = { 'foo': { int: any }, 'bar': { int: any } }
+            __retention__ = { 'age': 60, 'checkpoint': None }
+
+        doc = TestDocumentRevision({'foo':0,'bar':0})
+        doc.save()
+        for i in range(1, 6):
+            doc.foo = i
+            doc.save()
+        del doc['bar']
+        doc.save()
+        dates = [r['date'] for r in self.db.Revision.find({'item.$id':doc.id}).sort('date')]
+        states = [doc.at(date).export() for date in dates]
+
+        # Only the Revisions older than the cutoff are replaced
+        now = dates[4] + 60.0001
+        self.assertEquals(coconut.revision.compact(TestDocumentRevision, now), 5)
+        revisions = list(self.db.Revision.find({'item.$id':doc.id}).sort('date'))
+        self.assertEquals(len(revisions), 3)
+        self.assertTrue(revisions[0]['changes']['snapshot'])
+        self.assertEquals(revisions[0]['date'], dates[4])
+        for date, state in zip(dates[4:], states[4:]):
+            self.assertEquals(doc.at(date).export(), state)
+        self.assertEquals(list(doc.history('foo')), [5,4])
+        self.assertEquals(coconut.revision.compact(TestDocumentRevision, now), 0)
+
+        # Daily checkpoints keep one Revision per day
+        TestDocumentRevision.__retention__ = { 'age': 0, 'checkpoint': 'daily' }
+        day = coconut.revision.PERIODS['daily']
+        ids = [r['_id'] for r in revisions]
+        for i, _id in enumerate(ids):
+            self.db.Revision.update({'_id':_id}, {'$set':{'date':day*(1000+i//2)+i}})
+        self.assertEquals(coconut.revision.compact(TestDocumentRevision), 2)
+        revisions = list(self.db.Revision.find({'item.$id':doc.id}).sort('date'))
+        self.assertEquals([r['date'] for r in revisions], [day*1000+1, day*1001+2])
+        self.assertEquals(doc.at(day*1000+1).export(), states[5])
+        self.assertEquals(doc.at(day*1001+2).export(), states[6])
+
+    def test_index_paths (self):
+        '''With __index_paths__, Revisions list the paths they set and History queries them.'''
+
+        class TestDocumentRevision (coconut.container.Document):
+            __schema__ = {
+                'foo': { int: any },
+                'thang': { dict: { 'thing': { int: any } } },
+                'tags': { list: [ { str: any } ], range: all, 'default': [] },
+            }
+            __index_paths__ = True
+
+        doc = TestDocumentRevision({'foo':0,'thang':{'thing':0}})
+        doc.save()
+        doc.thang['thing'] = 1
+        doc.save()
+        doc.foo = 2
+        doc.save()
+        revisions = list(self.db.Revision.find({'item.$id':doc.id}).sort('date'))
+        self.assertEquals(revisions[0]['fields'], ['foo', 'tags', 'thang', 'thang.thing'])
+        self.assertEquals(revisions[1]['fields'], ['thang', 'thang.thing'])
+        self.assertEquals(revisions[2]['fields'], ['foo'])
+        history = doc.history('thang.thing')
+        self.assertEquals(history.get_query()['$or'][0], {'fields':'thang.thing'})
+        self.assertEquals(list(history), [1, 0])
+        self.assertEquals(list(doc.history('foo')), [2, 0])
+
+        # Lists saved with array operators are indexed too
+        doc.tags.append('a')
+        doc.save()
+        self.assertEquals(list(doc.history('tags')), [['a'], []])
+
+        # Revisions of classes without __index_paths__ have no fields
+        TestDocumentRevision.__index_paths__ = False
+        doc.foo = 3
+        doc.save()
+        self.assertNotIn('fields', self.db.Revision.find({'item.$id':doc.id}).sort('date',-1)[0])
+        # and are still found once it is turned on
+        TestDocumentRevision.__index_paths__ = True
+        self.assertEquals(list(doc.history('foo')), [3, 2, 0])
+        self.assertEquals(list(doc.history('tags')), [['a'], []])
+
+    def test_write_behind_revisions (self):
+        '''Revisions of write-behind classes are inserted in the background.'''
+
+        class TestDocumentRevision (coconut.container.Document):
+            __schema__ = { 'foo': { int: any } }
+            __durability__ = coconut.revision.WRITE_BEHIND
+
+        writer = coconut.revision.writer
+        coconut.revision.writer = coconut.revision.RevisionWriter(maxsize=2, batch_size=2)
+        try:
+            doc = TestDocumentRevision({'foo':0})
+            doc.save()
+            for i in range(1, 5):
+                doc.foo = i
+                doc.save()
+            docs = [TestDocumentRevision({'foo':i}) for i in range(3)]
+            TestDocumentRevision.save_all(docs)
+            coconut.revision.flush_revisions()
+        finally:
+            coconut.revision.writer = writer
+        self.assertEquals(list(doc.history('foo')), [4,3,2,1,0])
+        for other in docs:
+            self.assertEquals(len(coconut.revision.Revision.find({'item.$id':other.id})), 1)
+
+    def test_revision_collection (self):
+        '''__revision_collection__ routes Revisions to another collection or turns them off.'''
+
+        class TestDocumentRevision (coconut.container.Document):
+            __schema__ = { 'foo': { int: any } }
+            __revision_collection__ = True
+
+        class TestDocumentRevisionOff (coconut.container.Document):
+            __schema__ = { 'foo': { int: any } }
+            __revision_collection__ = False
+
+        try:
+            doc = TestDocumentRevision({'foo':0})
+            doc.save()
+            doc.foo = 1
+            doc.save()
+            TestDocumentRevision.save_all([TestDocumentRevision({'foo':2})])
+            self.assertEquals(self.db.TestDocumentRevision__revisions.find().count(), 3)
+            self.assertEquals(coconut.revision.Revision.find({'item.$id':doc.id}), [])
+            self.assertEquals(list(doc.history('foo')), [1,0])
+            self.assertEquals(doc.at(time.time()).foo, 1)
+            TestDocumentRevision.ensure_indexes()
+            keys = [info['key'] for info in self.db.TestDocumentRevision__revisions.index_information().values()]
+            self.assertIn([('item.$id', 1), ('date', 1)], keys)
+
+            off = TestDocumentRevisionOff({'foo':0})
+            off.save()
+            off.foo = 1
+            off.save()
+            self.assertEquals(coconut.revision.Revision.find({'item.$id':off.id}), [])
+            self.assertEquals(list(off.history()), [])
+        finally:
+            self.db.TestDocumentRevision__revisions.drop()
+            self.db.TestDocumentRevisionOff.remove()
+
+    def test_watch (self):
+        '''watch streams change events in order and resumes from a token.'''
+
+        class TestDocumentRevision (coconut.container.Document):
+            __schema__ = { 'foo': { int: any }, 'bar': { int: any } }
+
+        start = coconut.revision.watch([TestDocumentRevision], follow=False)
+        doc = TestDocumentRevision({'foo':0,'bar':0})
+        doc.save()
+        for i in range(1, 4):
+            doc.foo = i
+            doc.save()
+        doc.bar = 5
+        doc.save()
+
+        events = list(start)
+        self.assertEquals(len(events), 5)
+        self.assertEquals([e['changes']['set'].get('foo') for e in events], [0,1,2,3,None])
+        self.assertEquals(events[0]['type'], 'TestDocumentRevision')
+        self.assertEquals(events[0]['id'], doc.id)
+        resumed = coconut.revision.watch([TestDocumentRevision], since=events[1]['token'], follow=False, batch_size=2)
+        self.assertEquals([e['token'] for e in resumed], [e['token'] for e in events[2:]])
+        bar = coconut.revision.watch([TestDocumentRevision], since=events[0]['token'], fields=['bar'], follow=False)
+        self.assertEquals([e['token'] for e in bar], [events[4]['token']])
+
+    def test_local_notifier (self):
+        '''Subscribers are told of the changes saved in this process.'''
+
+        class TestDocumentRevision (coconut.container.Document):
+            __schema__ = { 'foo': { int: any }, 'bar': { int: any } }
+
+        events = []
+        foo_events = []
+        subscriptions = [
+            coconut.revision.subscribe(events.append, [TestDocumentRevision]),
+            coconut.revision.subscribe(foo_events.append, fields=['foo']),
+        ]
+        try:
+            doc = TestDocumentRevision({'foo':0})
+            doc.save()
+            doc.bar = 1
+            doc.save()
+            TestDocumentRevision.save_all([doc, TestDocumentRevision({'foo':2})])
+        finally:
+            for subscription in subscriptions:
+                coconut.revision.unsubscribe(subscription)
+        doc.foo = 3
+        doc.save()
+
+        self.assertEquals(len(events), 3)
+        self.assertEquals(events[0]['id'], doc.id)
+        self.assertEquals(events[1]['changes']['set'], {'bar':1})
+        self.assertEquals([e['changes']['set']['foo'] for e in foo_events], [0,2])
+        for event in events:
+            stored = self.db.Revision.find_one({'_id':ObjectId(event['token'])})
+            self.assertEquals(stored['item'].id, event['id'])
+
+    def test_history_appended_list (self):
+        '''The history of a list saved with array operators holds the whole list.'''
+
+        class TestDocumentRevision (coconut.container.Document):
+            __schema__ = { 'tags': { list: [ { str: any } ], range: all, 'default': [] } }
+
+        doc = TestDocumentRevision()
+        doc.save()
+        doc.tags.append('a')
+        doc.save()
+        doc.tags.append('b')
+        doc.save()
+        doc.tags.pop(0)
+        doc.save()
+        self.assertEquals(list(doc.history('tags')), [['b'], ['a','b'], ['a'], []])
+        self.assertEquals(list(doc.at(time.time()).tags), ['b'])
+
+    def test_write_behind_errors (self):
+        '''Failed background inserts are raised by flush_revisions without stopping the writer.'''
+
+        import bson.errors
+
+        class TestDocumentRevision (coconut.container.Document):
+            __schema__ = { 'foo': { int: any } }
+            __durability__ = coconut.revision.WRITE_BEHIND
+
+        def fail (event):
+            raise ValueError('subscriber failed')
+
+        writer = coconut.revision.writer
+        coconut.revision.writer = coconut.revision.RevisionWriter(batch_size=1)
+        try:
+            coconut.revision.writer.put(self.db.Revision, {'bad': object()})
+            doc = TestDocumentRevision({'foo':0})
+            doc.save()
+            self.assertRaises(bson.errors.InvalidDocument, coconut.revision.flush_revisions)
+            subscription = coconut.revision.subscribe(fail, [TestDocumentRevision])
+            try:
+                doc.foo = 1
+                doc.save()
+                self.assertRaises(ValueError, coconut.revision.flush_revisions)
+            finally:
+                coconut.revision.unsubscribe(subscription)
+            doc.foo = 2
+            doc.save()
+            coconut.revision.flush_revisions()
+            self.assertTrue(coconut.revision.writer.thread.is_alive())
+        finally:
+            coconut.revision.writer = writer
+        self.assertEquals(list(doc.history('foo')), [2,1,0])
+
+    def test_durability_constants (self):
+        '''Documents are synchronous by default and an unknown durability is rejected.'''
+
+        class TestDocumentRevision (coconut.container.Document):
+            __schema__ = { 'foo': { int: any } }
+
+        self.assertEquals(TestDocumentRevision.__durability__, coconut.revision.SYNC)
+        self.assertFalse(TestDocumentRevision.is_write_behind())
+        TestDocumentRevision.__durability__ = 'write_behind'
+        self.assertRaises(ValueError, TestDocumentRevision({'foo':1}).save)
+
     def test_flush_on_load (self):
         '''A freshly loaded document does not report any changes (because it is flushed).'''
 
@@ -1,10 +1,11 @@
 #!/usr/bin/python2.7
 
-import unittest
+import gc, unittest, weakref
 
 from pymongo import MongoClient
 
 import coconut.container
+import coconut.schema
 from coconut.error import *
 
 class TestDBSchema (unittest.TestCase):
@@ -85,6 +86,31 @@ class TestDBSchema (unittest.TestCase):
         doc.save()
         doc2 = TestDocumentSchemaType[doc.id]
         self.assertEquals(doc2['foo'],'bar')
+
+    def test_class_plan_compiled_once (self):
+        '''A Document schema is compiled once, and its containers use the nested plans.'''
+
+        class TestDocumentSchemaType (coconut.container.Document):
+            __schema__ = { 'thang': { dict: { 'thing': { str: any } } } }
+
+        plan = TestDocumentSchemaType.__plan__
+        doc = TestDocumentSchemaType({'thang':{'thing':'foo'}})
+        self.assertIs(doc.__plan__, plan)
+        self.assertIs(doc.thang.__plan__, plan.keys['thang'])
+
+    def test_adhoc_schema_not_retained (self):
+        '''Schemas passed to Schema.import_element and export_element are not kept alive.'''
+
+        class SchemaDict (dict):
+            pass
+
+        schema = SchemaDict({str: any})
+        self.assertEquals(coconut.schema.Schema.import_element('bar', schema, None), 'bar')
+        self.assertEquals(coconut.schema.Schema.export_element('bar', schema), 'bar')
+        ref = weakref.ref(schema)
+        del schema
+        gc.collect()
+        self.assertIsNone(ref())
         
 
 # TODO: attribute access for documents with the any schema        
@@ -0,0 +1,58 @@
+#!/usr/bin/python2.7
+
+import unittest
+
+from pymongo import MongoClient
+
+import coconut.container
+from coconut.session import Session
+
+class TestDocumentSession (coconut.container.Document):
+    __schema__ = {
+        'name': { str: any },
+        'link': { id: 'TestDocumentSession' },
+    }
+
+class TestDBSession (unittest.TestCase):
+    '''Test the Session identity map.'''
+
+    def setUp (self):
+        self.db = coconut.container.Document.__db__ = MongoClient().coconut_test
+
+    def tearDown(self):
+        self.db.TestDocumentSession.remove()
+
+    def test_lookup_returns_same_instance (self):
+        '''Looking up a Document twice in a Session returns the same instance.'''
+
+        doc = TestDocumentSession({'name':'foo'})
+        doc.save()
+        with Session():
+            doc1 = TestDocumentSession[doc.id]
+            doc2 = TestDocumentSession[doc.id]
+            doc3 = TestDocumentSession.find({'name':'foo'})[0]
+        self.assertIs (doc1, doc2)
+        self.assertIs (doc1, doc3)
+
+    def test_dereference_returns_same_instance (self):
+        '''Dereferencing Links to the same Document in a Session returns the same instance.'''
+
+        target = TestDocumentSession({'name':'target'})
+        target.save()
+        for name in ['a','b']:
+            TestDocumentSession({'name':name,'link':target}).save()
+        with Session() as session:
+            a = TestDocumentSession.find_first({'name':'a'})
+            b = TestDocumentSession.find_first({'name':'b'})
+            self.assertIs (a.link(), b.link())
+            self.assertIs (a.link(), session.get(TestDocumentSession, target.id))
+
+    def test_no_session_returns_new_instance (self):
+        '''Without a Session each lookup returns a new instance.'''
+
+        doc = TestDocumentSession({'name':'foo'})
+        doc.save()
+        self.assertIsNot (TestDocumentSession[doc.id], TestDocumentSession[doc.id])
+
+if __name__ == '__main__':
+    unittest.main()